@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+# Benchmarks the phases of extract.py on a timeline (an existing one, or one written by generate.py) and reports
+# throughput (MB/s, events/s) and peak RSS for each phase, with and without ujson. The extract_filtered phase fails if
+# the filter index does not let a single pid extract skip part of the window.
+#
+# Each phase runs in its own python process, so its peak RSS (ru_maxrss) is its own and the json module can be switched
+# with HTIMELINE_NO_UJSON. The "scan" phase builds the sidecar files (.sum.json/.idx) that the other phases load.
+
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+import importlib.util
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(abspath(__file__)))
+
+BYTES_PER_MB = 1000 * 1000.
+SEARCH_LOOKUPS = 100 * 1000
+PHASES = ["scan", "summarize", "find_metadata_events", "build_index", "search_index", "extract", "extract_passthrough",
+          "extract_filtered"]
+
+
+def print(s):
+    sys.stdout.write(f'{s}\n')
+
+
+def extracted_event_count(h, extract_file_path):
+    with open(extract_file_path, 'rb') as f:
+        return sum(1 for _ in f) - len(h.metadata_events) - 1
+
+
+# Runs one phase in this process. Returns the bytes and events it processed. For search_index, events is the number
+# of lookups
+def run_phase(phase, timeline_path, extract_start, extract_duration, workers):
+    from extract import HorovodTimeline
+
+    if phase == "scan":
+        start = time.time()
+        h = HorovodTimeline(timeline_path, build_new_summary=True, workers=workers)
+        return time.time() - start, h.file_size_bytes, h.line_count
+
+    h = HorovodTimeline(timeline_path)
+    if phase == "summarize":
+        start = time.time()
+        line_count, _, _ = h.summarize()
+        return time.time() - start, h.file_size_bytes, line_count
+
+    if phase == "find_metadata_events":
+        max_lines = 5 * 1000 * 1000
+        start = time.time()
+        h.find_metadata_events(max_lines)
+        elapsed = time.time() - start
+        lines = min(max_lines, h.line_count)
+        return elapsed, int(h.file_size_bytes * lines / max(h.line_count, 1)), lines
+
+    if phase == "build_index":
+        start = time.time()
+        h.build_index(h.index.bytes_per_index or max(h.file_size_bytes // max(len(h.index), 1), 1))
+        return time.time() - start, h.file_size_bytes, h.line_count
+
+    if phase == "search_index":
+        r = random.Random(0)
+        lookups = [r.randint(int(h.min_ts), int(h.max_ts)) for _ in range(SEARCH_LOOKUPS)]
+        start = time.time()
+        for ts in lookups:
+            h.search_index(ts)
+        return time.time() - start, 0, SEARCH_LOOKUPS
+
+    if phase in ("extract", "extract_passthrough"):
+        if extract_start is None:
+            extract_start = max(h.duration_secs / 2 - extract_duration / 2, 0)
+        min_extract_ts, max_extract_ts, min_buffer_byte, max_buffer_byte = h.window_bounds(extract_start,
+                                                                                          extract_duration)
+        start = time.time()
+        extract_file_path, _ = h.extract_and_save_slice(extract_start, extract_duration,
+                                                        passthrough=phase == "extract_passthrough")
+        elapsed = time.time() - start
+        events = extracted_event_count(h, extract_file_path)
+        os.remove(extract_file_path)
+        return elapsed, max_buffer_byte - min_buffer_byte, events
+
+    if phase == "extract_filtered":
+        # Passthrough extract of the lowest pid, with the filter index built first (not timed). Bytes are those the
+        # filter index leaves to read, which must be fewer than the window's
+        if h.load_filter_index() is None:
+            h.build_filter_index()
+        if extract_start is None:
+            extract_start = max(h.duration_secs / 2 - extract_duration / 2, 0)
+        pids = [min(e["pid"] for e in h.metadata_events if isinstance(e.get("pid"), int))]
+        _, _, min_buffer_byte, max_buffer_byte = h.window_bounds(extract_start, extract_duration)
+        mm = h.map()
+        bytes_to_read = sum(end - start for start, end in
+                            h.filtered_byte_ranges(mm, min_buffer_byte, max_buffer_byte, pids=pids))
+        mm.close()
+        if bytes_to_read >= max_buffer_byte - min_buffer_byte:
+            raise RuntimeError(f'The filter index did not skip any of the {max_buffer_byte - min_buffer_byte} bytes '
+                               f'of the window for pid {pids[0]}')
+        start = time.time()
+        extract_file_path, _ = h.extract_and_save_slice(extract_start, extract_duration, passthrough=True, pids=pids)
+        elapsed = time.time() - start
+        events = extracted_event_count(h, extract_file_path)
+        os.remove(extract_file_path)
+        return elapsed, bytes_to_read, events
+
+    raise RuntimeError(f'Unknown phase {phase}. Choose from {PHASES}')
+
+
+# Runs a phase in a child process and returns its result dict
+def run_phase_process(phase, json_library, args):
+    env = dict(os.environ)
+    if json_library == "json":
+        env["HTIMELINE_NO_UJSON"] = "1"
+    else:
+        env.pop("HTIMELINE_NO_UJSON", None)
+
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as result_file:
+        result_path = result_file.name
+    try:
+        command = [sys.executable, abspath(__file__), "--run_phase", phase, "--timeline", args.timeline,
+                   "--result_file", result_path, "--extract_duration", str(args.extract_duration),
+                   "--workers", str(args.workers)]
+        if args.extract_start is not None:
+            command += ["--extract_start", str(args.extract_start)]
+        completed = subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if completed.returncode != 0:
+            raise RuntimeError(f'Phase {phase} failed:\n{completed.stderr.decode(errors="replace")}')
+        with open(result_path, 'r') as f:
+            result = json.load(f)
+    finally:
+        os.remove(result_path)
+
+    result.update(phase=phase, json=json_library)
+    return result
+
+
+def print_results(results):
+    header = f'{"phase":<24} {"json":<6} {"time (s)":>10} {"MB/s":>10} {"events/s":>14} {"peak RSS (MB)":>14}'
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        seconds = max(result["seconds"], 1e-9)
+        mb_per_sec = f'{result["bytes"] / BYTES_PER_MB / seconds:,.2f}' if result["bytes"] else "-"
+        print(f'{result["phase"]:<24} {result["json"]:<6} {result["seconds"]:>10,.2f} {mb_per_sec:>10} '
+              f'{int(result["events"] / seconds):>14,} {result["peak_rss_bytes"] / BYTES_PER_MB:>14,.2f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="HorovodTimelineBenchmark")
+
+    parser.add_argument('--timeline', type=str, help='Timeline to benchmark. Written with generate.py if it does not exist. Required', required=True)
+    parser.add_argument('--generate_mb', help='Size in MB of the generated timeline. Default=1000', type=float, default=1000.)
+    parser.add_argument('--tensors', help='Tensors (pids) in the generated timeline. Default=100', type=int, default=100)
+    parser.add_argument('--ranks', help='Ranks in the generated timeline. Default=8', type=int, default=8)
+    parser.add_argument('--events_per_sec', help='Event rate of the generated timeline. Default=100000', type=int, default=100 * 1000)
+    parser.add_argument('--seed', help='Random seed of the generated timeline. Default=0', type=int, default=0)
+
+    parser.add_argument('--phases', help=f'Comma separated phases to run. Default={",".join(PHASES)}', type=str, default=",".join(PHASES))
+    parser.add_argument('--json', help='Comma separated json libraries to compare (ujson, json). Default=ujson,json', type=str, default="ujson,json")
+    parser.add_argument('--extract_start', help='Start in seconds of the extracted window. Default=middle of the timeline', type=float, default=None)
+    parser.add_argument('--extract_duration', help='Duration in seconds of the extracted window. Default=10', type=float, default=10.)
+    parser.add_argument('--workers', help='Workers for the scan phase. Default=1', type=int, default=1)
+    parser.add_argument('--output', help='Also write the results as JSON to this path', type=str, default=None)
+
+    # Internal: run a single phase and write its result to --result_file
+    parser.add_argument('--run_phase', help=argparse.SUPPRESS, type=str, default=None)
+    parser.add_argument('--result_file', help=argparse.SUPPRESS, type=str, default=None)
+
+    ARGS = parser.parse_args()
+    ARGS.timeline = abspath(ARGS.timeline)
+
+    if ARGS.run_phase:
+        seconds, byte_count, events = run_phase(ARGS.run_phase, ARGS.timeline, ARGS.extract_start,
+                                                ARGS.extract_duration, ARGS.workers)
+        with open(ARGS.result_file, 'w') as result_file:
+            json.dump({
+                "seconds": seconds,
+                "bytes": byte_count,
+                "events": events,
+                "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            }, result_file)
+        sys.exit(0)
+
+    if not os.path.exists(ARGS.timeline):
+        from generate import generate
+        print(f'Generating {ARGS.generate_mb} MB timeline {ARGS.timeline}')
+        generate(ARGS.timeline, int(ARGS.generate_mb * BYTES_PER_MB), tensors=ARGS.tensors, ranks=ARGS.ranks,
+                 events_per_sec=ARGS.events_per_sec, seed=ARGS.seed)
+
+    phases = ARGS.phases.split(",")
+    for phase in phases:
+        if phase not in PHASES:
+            raise RuntimeError(f'Unknown phase {phase}. Choose from {PHASES}')
+    json_libraries = ARGS.json.split(",")
+    if "ujson" in json_libraries and importlib.util.find_spec("ujson") is None:
+        print("ujson is not installed, only benchmarking the json module")
+        json_libraries = [library for library in json_libraries if library != "ujson"]
+
+    results = []
+    for json_library in json_libraries:
+        # Every run starts with a fresh metadata build, which the other phases load
+        ordered_phases = ["scan"] + [phase for phase in phases if phase != "scan"]
+        for phase in ordered_phases:
+            result = run_phase_process(phase, json_library, ARGS)
+            if phase in phases:
+                results.append(result)
+                print(f'{phase} ({json_library}): {result["seconds"]:,.2f}s')
+
+    print("")
+    print(f'Timeline: {ARGS.timeline} ({os.stat(ARGS.timeline).st_size / BYTES_PER_MB:,.2f} MB)')
+    print("")
+    print_results(results)
+
+    if ARGS.output:
+        with open(ARGS.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
@@ -6,6 +6,24 @@ from os.path import abspath
 import itertools, sys
 import time
 import argparse
+import multiprocessing
+import struct
+import mmap
+import bisect
+import heapq
+import re
+import math
+import random
+import zlib
+import base64
+import resource
+import hashlib
+import tempfile
+import threading
+import shutil
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from array import array
 
 spinner = itertools.cycle(['\\', '|', '/', '-'])
 MICROSECONDS_PER_SEC = 1000 * 1000.
@@ -15,7 +33,10 @@ BYTES_PER_GB = 1000 * 1000 * 1000.
 BYTES_PER_TB = 1000 * 1000 * 1000 * 1000.
 BYTES_PER_PB = 1000 * 1000 * 1000 * 1000 * 1000.
 
+# HTIMELINE_NO_UJSON=1 forces the json module, e.g. to benchmark without ujson
 try:
+    if os.environ.get("HTIMELINE_NO_UJSON"):
+        raise ImportError
     import ujson as json
 except ImportError:
     print("#########################################################################################################")
@@ -24,6 +45,19 @@ except ImportError:
     import json
 
 
+# Only needed for querying columnar timelines
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Only needed for zstd compressed timelines
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
 try:
     from tqdm import tqdm
 except ImportError:
@@ -112,6 +146,1266 @@ def blocks(files, size=65536):
 
 
 
+# Number of JSON decodes and decode failures in this process, read by Profiler. Work done in pool workers is added
+# back by map_byte_range_shards()
+PARSE_COUNTS = {"decodes": 0, "failures": 0}
+
+def add_parse_counts(counts):
+    for key, count in counts.items():
+        PARSE_COUNTS[key] += count
+
+def current_rss_bytes():
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * mmap.PAGESIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Per-phase instrumentation, written as JSON by --profile. Each phase records wall time, bytes and lines read, JSON
+# decodes and decode failures, and memory: current RSS and peak RSS of this process and of finished worker processes.
+# Phases can nest (e.g. scan inside load). Counts are added to every open phase, so a phase includes its inner phases.
+class Profiler:
+    def __init__(self):
+        self.phases = []
+        self.open_phases = []
+        self.info = {}
+
+    def start(self, name):
+        phase = ProfilePhase(self, name)
+        self.phases.append(phase.record)
+        self.open_phases.append(phase)
+        return phase
+
+    def count(self, bytes_read=0, lines=0):
+        for phase in self.open_phases:
+            phase.record["bytes_read"] += bytes_read
+            phase.record["lines"] += lines
+
+    def report(self):
+        return dict(self.info, phases=self.phases)
+
+    def save(self, path):
+        with open(path, 'w+') as profile_file:
+            json.dump(self.report(), profile_file, indent=4)
+
+
+class ProfilePhase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.record = {
+            "phase": name,
+            "parent": profiler.open_phases[-1].record["phase"] if profiler.open_phases else None,
+            "wall_secs": None,
+            "bytes_read": 0,
+            "lines": 0,
+            "json_decodes": 0,
+            "json_decode_failures": 0,
+        }
+        self.start_time = time.time()
+        self.start_counts = dict(PARSE_COUNTS)
+
+    def stop(self, bytes_read=0, lines=0):
+        self.profiler.count(bytes_read=bytes_read, lines=lines)
+        self.record["wall_secs"] = time.time() - self.start_time
+        self.record["json_decodes"] = PARSE_COUNTS["decodes"] - self.start_counts["decodes"]
+        self.record["json_decode_failures"] = PARSE_COUNTS["failures"] - self.start_counts["failures"]
+        self.record["rss_bytes"] = current_rss_bytes()
+        self.record["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.record["workers_peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        self.profiler.open_phases.remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+# Module level so they can be used from worker processes as well as from HorovodTimeline.
+# Accept both str lines and raw bytes lines.
+def parse_line_as_json(line, verbose=True):
+    line = line.strip()
+    if line[-2:] in ("},", b"},"):
+        line = line[:-1]
+
+    if line in ("]", "[", b"]", b"["):
+        return None
+
+    PARSE_COUNTS["decodes"] += 1
+    try:
+        j = json.loads(line)
+        return j
+    except Exception as ex:
+        PARSE_COUNTS["failures"] += 1
+        if verbose:
+            sys.stdout.write(str(ex))
+            sys.stdout.write(f'[json.loads | ERROR]: "{line}"\n')
+        return None
+
+def extract_ts_from_line(line, verbose=True):
+    j = parse_line_as_json(line, verbose=verbose)
+    if j is None:
+        return None
+    else:
+        return j['ts'] if 'ts' in j.keys() else None
+
+
+# Timestamp extractors. Every extractor takes (line, verbose) where line is str or bytes and returns the ts of the
+# event or None. extract_ts_fast finds the ts value with a regex over the raw line and only falls back to decoding
+# the whole event when the line mentions "ts" in a form the regex does not handle.
+TS_PATTERN = re.compile(rb'"ts":\s*(-?[0-9]+(?:\.[0-9]+)?)[,}\s]')
+TS_PATTERN_STR = re.compile(TS_PATTERN.pattern.decode())
+
+def extract_ts_fast(line, verbose=False):
+    if isinstance(line, str):
+        m = TS_PATTERN_STR.search(line)
+        has_ts_key = '"ts"' in line
+    else:
+        m = TS_PATTERN.search(line)
+        has_ts_key = b'"ts"' in line
+
+    if m is not None:
+        try:
+            return int(m.group(1))
+        except ValueError:
+            return float(m.group(1))
+    if has_ts_key:
+        return extract_ts_from_line(line, verbose=verbose)
+    return None
+
+TS_EXTRACTORS = {
+    "fast": extract_ts_fast,
+    "json": extract_ts_from_line,
+}
+
+# Yields the raw bytes of every line that starts in [start_byte, end_byte). start_byte must be at a line boundary.
+# Pages that have been read are dropped from the mapping every release_bytes so resident memory stays flat.
+def iter_raw_lines(mm, start_byte, end_byte, release_bytes=64 * 1024 * 1024):
+    pos = start_byte
+    released = start_byte - start_byte % mmap.PAGESIZE
+    while pos < end_byte:
+        newline = mm.find(b'\n', pos)
+        if newline < 0:
+            line = mm[pos:]
+            if line:
+                yield line
+            return
+        yield mm[pos:newline + 1]
+        pos = newline + 1
+
+        if pos - released > release_bytes:
+            release_end = pos - pos % mmap.PAGESIZE
+            mm.madvise(mmap.MADV_DONTNEED, released, release_end - released)
+            released = release_end
+
+# Strip the trailing newline and the separating comma so the line can be re-joined with ',\n'
+def strip_raw_line(line):
+    line = line.rstrip()
+    if line.endswith(b','):
+        line = line[:-1]
+    return line
+
+
+
+# --overview starts with this many time buckets and widens them until the trace has at most OVERVIEW_MAX_EVENTS events
+OVERVIEW_BUCKETS = 4096
+OVERVIEW_MAX_EVENTS = 20000
+
+# Compressed timelines. gzip (.gz) is read with zlib, zstd (.zst/.zstd) with the optional zstandard module
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+CHECKPOINT_SPACING_BYTES = 16 * 1024 * 1024
+# Extracts of at least PARALLEL_EXTRACT_MIN_BYTES are written by self.workers processes, in parts of about
+# PARALLEL_EXTRACT_PART_BYTES
+PARALLEL_EXTRACT_MIN_BYTES = 64 * 1024 * 1024
+PARALLEL_EXTRACT_PART_BYTES = 32 * 1024 * 1024
+# Index buckets larger than REFINE_MIN_BYTES that an extract starts or ends in are split into REFINE_SAMPLES parts by
+# sampling lines, until they are at most REFINE_MIN_BYTES (see HorovodTimeline.refine_index)
+REFINE_MIN_BYTES = 1024 * 1024
+REFINE_SAMPLES = 16
+# Bucket size of the filter index, independent of the timestamp index spacing. Every tensor is active in every training
+# step, so buckets must be a fraction of a step for a name or pid filter to skip anything
+FILTER_BUCKET_BYTES = 16 * 1024
+# min_ts is the ts of the first timestamped line, not the lowest ts in the file (events are written slightly out of
+# order), so --start_time windows line up with those of older versions. Recorded in the summary; summaries without it
+# get min_ts recomputed
+MIN_TS_ORIGIN = "first_line"
+# A timeline's content is identified by its size and hashes of its first and last FINGERPRINT_BLOCK_BYTES (see
+# timeline_fingerprint). HTIMELINE_INDEX_CACHE_DIR is the default directory of the shared index cache (see IndexCache)
+FINGERPRINT_BLOCK_BYTES = 64 * 1024
+INDEX_CACHE_ENV = "HTIMELINE_INDEX_CACHE_DIR"
+INDEX_CACHE_BYTES = 1000 * 1000 * 1000
+# --stats --approx reads the line holding each of APPROX_SAMPLES random offsets, APPROX_READ_BYTES at a time, and
+# reports intervals at 95% confidence
+APPROX_SAMPLES = 256
+APPROX_READ_BYTES = 4096
+APPROX_Z = 1.96
+
+def compression_for_path(path):
+    for extension, compression in COMPRESSION_EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+# Read-only view of the decompressed bytes of a gzip or zstd timeline. Supports the parts of the file and mmap
+# interfaces that the rest of this module uses (read/readline/seek/tell/iteration and find/slicing/madvise), so code
+# written against an mmap of a plain timeline works unchanged.
+#
+# Decompression can only start at the beginning of a gzip member or zstd frame. Those restart points are recorded as
+# (uncompressed offset, compressed offset) checkpoints, at least CHECKPOINT_SPACING_BYTES apart, while the file is
+# read. Given the checkpoints from a previous scan, access to any offset starts decompressing from the last checkpoint
+# before it. Single member gzip files have one checkpoint at 0; multi-member gzip (bgzip) and multi-frame zstd (pzstd)
+# files give many.
+class DecompressedTimeline:
+    READ_BYTES = 1024 * 1024
+    KEEP_BYTES = 64 * 1024 * 1024   # decompressed bytes kept behind the current position
+
+    def __init__(self, path, compression, checkpoints=None):
+        if compression == "zstd" and zstandard is None:
+            raise RuntimeError("zstandard module is required to read zstd compressed timelines")
+        self.compression = compression
+        self.f = open(path, 'rb')
+        self.checkpoints = sorted(set([(0, 0)] + [tuple(c) for c in (checkpoints or [])]))
+        self.pos = 0
+        self.restart(0, 0)
+
+    def new_decompressor(self):
+        if self.compression == "gzip":
+            return zlib.decompressobj(wbits=31)
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def restart(self, uncompressed_offset, compressed_offset):
+        self.f.seek(compressed_offset)
+        self.compressed_offset = compressed_offset
+        self.decompressor = self.new_decompressor()
+        self.buffer = bytearray()
+        self.buffer_start = uncompressed_offset
+        self.eof = False
+
+    def record_checkpoint(self, uncompressed_offset, compressed_offset):
+        last_uncompressed_offset = self.checkpoints[-1][0]
+        if uncompressed_offset >= last_uncompressed_offset + CHECKPOINT_SPACING_BYTES:
+            self.checkpoints.append((uncompressed_offset, compressed_offset))
+
+    # Decompress the next READ_BYTES of compressed data into the buffer. Returns False at the end of the file
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.f.read(self.READ_BYTES)
+        if not data:
+            self.eof = True
+            return False
+        self.compressed_offset += len(data)
+
+        buffer_end = self.buffer_start + len(self.buffer)
+        while data:
+            out = self.decompressor.decompress(data)
+            self.buffer += out
+            buffer_end += len(out)
+            if not self.decompressor.eof:
+                break
+            # End of a gzip member / zstd frame. The next one is a restart point
+            data = self.decompressor.unused_data
+            self.decompressor = self.new_decompressor()
+            self.record_checkpoint(buffer_end, self.compressed_offset - len(data))
+        return True
+
+    # Make sure the buffer holds pos, restarting from a checkpoint when pos is behind the buffer or far ahead of it
+    def goto(self, pos):
+        buffer_end = self.buffer_start + len(self.buffer)
+        checkpoint = self.checkpoints[bisect.bisect_right(self.checkpoints, (pos, float('inf'))) - 1]
+        if pos < self.buffer_start or checkpoint[0] > buffer_end:
+            self.restart(*checkpoint)
+
+        while self.buffer_start + len(self.buffer) <= pos:
+            self.buffer_start += len(self.buffer)
+            self.buffer = bytearray()
+            if not self.fill():
+                return
+
+        if pos - self.buffer_start > self.KEEP_BYTES:
+            del self.buffer[:pos - self.buffer_start]
+            self.buffer_start = pos
+
+    def ensure(self, end):
+        while self.buffer_start + len(self.buffer) < end:
+            if not self.fill():
+                return
+
+    def find(self, sub, start=0):
+        self.goto(start)
+        search_from = start
+        while True:
+            i = self.buffer.find(sub, search_from - self.buffer_start)
+            if i >= 0:
+                return self.buffer_start + i
+            search_from = max(start, self.buffer_start + len(self.buffer) - len(sub) + 1)
+            if not self.fill():
+                return -1
+
+    def __getitem__(self, key):
+        start = key.start or 0
+        self.goto(start)
+        if key.stop is None:
+            while self.fill():
+                pass
+        else:
+            self.ensure(key.stop)
+        stop = self.buffer_start + len(self.buffer) if key.stop is None else key.stop
+        return bytes(self.buffer[start - self.buffer_start:stop - self.buffer_start])
+
+    def read(self, size=-1):
+        data = self[self.pos:None if size < 0 else self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def readline(self):
+        newline = self.find(b'\n', self.pos)
+        data = self[self.pos:None if newline < 0 else newline + 1]
+        self.pos += len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def seek(self, pos, whence=0):
+        self.pos = pos if whence == 0 else self.pos + pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def madvise(self, *args):
+        pass
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Random access view of the (decompressed) bytes of a timeline: an mmap for plain files, else a DecompressedTimeline
+def map_timeline(path, compression=None, checkpoints=None):
+    if compression is None:
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return DecompressedTimeline(path, compression, checkpoints=checkpoints)
+
+def open_timeline(path, compression=None, checkpoints=None):
+    if compression is None:
+        return open(path, 'rb')
+    return DecompressedTimeline(path, compression, checkpoints=checkpoints)
+
+
+
+SCAN_BLOCK_BYTES = 4 * 1024 * 1024
+TAIL_BYTES = 100 * 1000
+EXTRACT_WRITE_BUFFER_BYTES = 16 * 1024 * 1024
+
+# Op name -> category for the activity rollup, by the first matching part of the name. The collective spans
+# (ALLREDUCE, ...) contain the memcpy and communicate spans of the same tensor
+OP_CATEGORIES = (
+    ("NEGOTIATE", "negotiate"),
+    ("WAIT", "wait"),
+    ("QUEUE", "wait"),
+    ("MEMCPY", "memcpy"),
+    ("NCCL", "communicate"),
+    ("MPI", "communicate"),
+    ("GLOO", "communicate"),
+    ("CCL", "communicate"),
+    ("ALLREDUCE", "collective"),
+    ("ALLGATHER", "collective"),
+    ("BROADCAST", "collective"),
+    ("ALLTOALL", "collective"),
+    ("REDUCESCATTER", "collective"),
+)
+
+def op_category(name):
+    if isinstance(name, bytes):
+        name = name.decode(errors="replace")
+    for part, category in OP_CATEGORIES:
+        if part in str(name):
+            return category
+    return "other"
+
+# Matches lines as written by Horovod's timeline writer, or else (last group) any other line with a ts, which is decoded
+ROLLUP_LINE_PATTERN = re.compile(rb'^(?:\{"ph": "([BEX])"(?:, "name": "([^"]*)")?, "ts": (-?[0-9]+), "pid": (-?[0-9]+)'
+                                 rb'(?:, "tid": (-?[0-9]+))?(?:, "dur": ([0-9]+))?|(.*"ts".*))', re.M)
+ROLLUP_PHASES = {b'B': 'B', b'E': 'E', b'X': 'X'}
+# --stats prints the rollup in at most ACTIVITY_ROWS rows. Seconds with fewer events than IDLE_FRACTION of the median
+# are idle
+ACTIVITY_ROWS = 24
+IDLE_FRACTION = 0.1
+
+# Per-second activity of a timeline, saved as <timeline>.rollup.json by the metadata scan so --stats can show it
+# without reading the timeline. For every second (ts // 1s): the event count, the ranks that reported ready in a
+# negotiation (the "X" events named by rank number inside NEGOTIATE_* spans), and the busy time of each op category,
+# split over the seconds a span covers. Busy time adds up over tensors, so it can be more than a second per second.
+# B/E pairing across shards works like OpStats; B events still open at the end are saved so appends can close them.
+class ActivityRollup:
+    SECOND_US = 1000 * 1000
+
+    def __init__(self):
+        # second -> [events, set of ranks, {category: busy_us}, rank count loaded from the sidecar]
+        self.seconds = {}
+        self.categories = {}
+        self.open_begins = {}
+        self.orphan_ends = []
+        # Bytes of the timeline added so far
+        self.covered_bytes = 0
+
+    def activity(self, second):
+        activity = self.seconds.get(second)
+        if activity is None:
+            activity = self.seconds[second] = [0, set(), {}, 0]
+        return activity
+
+    def busy(self, name, start_ts, end_ts):
+        category = self.categories.get(name)
+        if category is None:
+            category = self.categories[name] = op_category(name)
+        while start_ts < end_ts:
+            second = start_ts // self.SECOND_US
+            second_end_ts = min(end_ts, (second + 1) * self.SECOND_US)
+            busy = self.activity(second)[2]
+            busy[category] = busy.get(category, 0) + second_end_ts - start_ts
+            start_ts = second_end_ts
+
+    def add(self, ph, name, ts, key, dur):
+        activity = self.activity(ts // self.SECOND_US)
+        activity[0] += 1
+        if ph == 'B':
+            self.open_begins.setdefault(key, []).append((name, ts))
+        elif ph == 'E':
+            stack = self.open_begins.get(key)
+            if stack:
+                name, begin_ts = stack.pop()
+                self.busy(name, begin_ts, ts)
+            else:
+                self.orphan_ends.append((key, ts))
+        elif ph == 'X':
+            if name is not None and name.isdigit():
+                activity[1].add(int(name))
+            elif dur:
+                self.busy(name, ts, ts + dur)
+
+    def add_event(self, j):
+        ph = j.get('ph')
+        ts = j.get('ts')
+        if ph is None or not isinstance(ts, (int, float)):
+            return
+        self.add(ph, j.get('name'), int(ts), (j.get('pid'), j.get('tid')), int(j.get('dur', 0)))
+
+    # Adds the complete lines of a block. Lines without a ts (metadata events) are skipped by the regex
+    def add_lines(self, block):
+        for m in ROLLUP_LINE_PATTERN.finditer(block):
+            ph, name, ts, pid, tid, dur, other = m.groups()
+            if other is not None:
+                j = parse_line_as_json(other, verbose=False)
+                if j is not None:
+                    self.add_event(j)
+                continue
+            self.add(ROLLUP_PHASES[ph], name, int(ts), (int(pid), int(tid) if tid is not None else None),
+                     int(dur) if dur is not None else 0)
+
+    # other covers the bytes directly after self
+    def merge(self, other):
+        for key, end_ts in other.orphan_ends:
+            stack = self.open_begins.get(key)
+            if stack:
+                name, begin_ts = stack.pop()
+                self.busy(name, begin_ts, end_ts)
+            else:
+                self.orphan_ends.append((key, end_ts))
+
+        for second, (events, ranks, busy, rank_count) in other.seconds.items():
+            activity = self.activity(second)
+            activity[0] += events
+            activity[1] |= ranks
+            # Ranks of a second split by an append are only known as counts
+            activity[3] = max(activity[3], rank_count)
+            for category, busy_us in busy.items():
+                activity[2][category] = activity[2].get(category, 0) + busy_us
+        for key, stack in other.open_begins.items():
+            self.open_begins.setdefault(key, []).extend(stack)
+
+    # (first second, events, ranks, {category: busy_us}) as columns with one entry per second from the first to the
+    # last second with activity
+    def columns(self):
+        if not self.seconds:
+            return 0, [], [], {}
+        first_second = min(self.seconds)
+        second_count = max(self.seconds) - first_second + 1
+        events = [0] * second_count
+        ranks = [0] * second_count
+        busy_us = {}
+        for second, (event_count, rank_set, busy, rank_count) in self.seconds.items():
+            i = second - first_second
+            events[i] = event_count
+            ranks[i] = max(len(rank_set), rank_count)
+            for category, category_busy_us in busy.items():
+                busy_us.setdefault(category, [0] * second_count)[i] = category_busy_us
+        return first_second, events, ranks, busy_us
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            saved = json.load(f)
+        rollup = cls()
+        rollup.covered_bytes = saved["covered_bytes"]
+        for i, (events, ranks) in enumerate(zip(saved["events"], saved["ranks"])):
+            if events or ranks:
+                rollup.seconds[saved["first_second"] + i] = [events, set(), {}, ranks]
+        for category, column in saved["busy_us"].items():
+            for i, busy_us in enumerate(column):
+                if busy_us:
+                    rollup.activity(saved["first_second"] + i)[2][category] = busy_us
+        for pid, tid, name, ts in saved["open_begins"]:
+            rollup.open_begins.setdefault((pid, tid), []).append((name, ts))
+        return rollup
+
+    def save(self, path):
+        first_second, events, ranks, busy_us = self.columns()
+        open_begins = [[pid, tid, name.decode(errors="replace") if isinstance(name, bytes) else name, ts]
+                       for (pid, tid), stack in self.open_begins.items() for name, ts in stack]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                "covered_bytes": self.covered_bytes,
+                "first_second": first_second,
+                "events": events,
+                "ranks": ranks,
+                "busy_us": busy_us,
+                "open_begins": open_begins,
+            }, f)
+        os.replace(tmp_path, path)
+
+# Training steps are found from NEGOTIATE_ALLREDUCE: every step each tensor starts one negotiation, so the "B" events of
+# NEGOTIATE_ALLREDUCE of one tensor (the step pid) mark the step boundaries. Horovod numbers pids by first appearance,
+# so the lowest pids can be one-off allreduces (warm-up, metric syncs). The step pid is the one with the most boundaries
+# among the STEP_CANDIDATE_PIDS lowest pids that negotiate
+STEP_MARKER = b'"NEGOTIATE_ALLREDUCE"'
+STEP_CANDIDATE_PIDS = 16
+STEP_PHASE_PATTERN = re.compile(rb'"ph":\s*"B"')
+PID_PATTERN = re.compile(rb'"pid":\s*([0-9]+)')
+
+# Single sequential read over [start_byte, end_byte) that does the work of summarize(), find_metadata_events() and
+# build_index() at once: counts newlines, collects metadata events from the first max_metadata_lines lines and samples
+# one (ts, byte) index entry per bytes_per_index bytes.
+#
+# With index_steps=True it also records the (ts, line start byte) of every step boundary, which looks at every
+# NEGOTIATE_ALLREDUCE line and roughly doubles the cost of the scan. With step_pid=None the boundaries of the
+# STEP_CANDIDATE_PIDS lowest negotiating pids of the range are kept in steps_by_pid and the step pid is chosen among them
+# (see choose_step_pid). A pid among the lowest of the whole file is among the lowest of every range it appears in, so
+# merge_scan_results() can choose from the merged candidates. Without index_steps the result has steps=None and
+# step_pid=None.
+# With rollup=True every line is also added to an ActivityRollup, which makes the scan several times slower.
+#
+# Index entries are sampled on a fixed grid (one per multiple of bytes_per_index): the sample is the first full line
+# after the grid point and the recorded byte is the offset just after that line, the same as build_index(). Using a
+# grid rather than jumping from the previous sample means any byte range scans to the same entries as a full scan.
+#
+# end_byte=None scans to the end of the file. The ts of the lines in the last TAIL_BYTES of the range are read so
+# max_ts is the true maximum for the range. For compressed timelines the result also holds the decompression
+# checkpoints seen and progress is reported in compressed bytes.
+def scan_byte_range(path, start_byte, end_byte, bytes_per_index, max_metadata_lines=0, pbar=None,
+                    ts_extractor=extract_ts_fast, compression=None, checkpoints=None, step_pid=None, rollup=False,
+                    index_steps=False):
+    line_count = 0
+    metadata_lines_scanned = 0
+    metadata_events = []
+    metadata_line_numbers = []
+    index = []
+    min_ts = None
+    max_ts = None
+    find_step_pid = step_pid is None
+    steps_by_pid = {} if find_step_pid else {step_pid: []}
+    rollup = ActivityRollup() if rollup else None
+
+    next_target = max(bytes_per_index, -(-start_byte // bytes_per_index) * bytes_per_index)
+    sample_start = None
+
+    if end_byte is None:
+        end_byte = float('inf')
+
+    with open_timeline(path, compression, checkpoints) as f:
+        f.seek(start_byte)
+        pos = start_byte
+        progress = f.compressed_offset if compression else start_byte
+        carry = b''
+        tail = b''
+        while pos < end_byte:
+            block = f.read(int(min(SCAN_BLOCK_BYTES, end_byte - pos)))
+            if not block:
+                break
+            pos += len(block)
+            if pbar is not None:
+                new_progress = f.compressed_offset if compression else pos
+                pbar.update(new_progress - progress)
+                progress = new_progress
+
+            line_count += block.count(b'\n')
+            tail = (tail + block)[-TAIL_BYTES:]
+
+            # Only complete lines are looked at. The partial line at the end of the block is carried to the next block
+            data = carry + block
+            data_start = pos - len(data)
+            region_len = data.rfind(b'\n') + 1
+            carry = data[region_len:]
+            if region_len == 0:
+                continue
+            region_end = data_start + region_len
+
+            if metadata_lines_scanned < max_metadata_lines:
+                lines = data[:region_len].split(b'\n')[:-1]
+                lines = lines[:max_metadata_lines - metadata_lines_scanned]
+                metadata_lines_scanned += len(lines)
+                for line_number, line in enumerate(lines, metadata_lines_scanned - len(lines)):
+                    ts = ts_extractor(line, verbose=False)
+                    if ts is not None:
+                        min_ts = ts if min_ts is None else min(min_ts, ts)
+                        max_ts = ts if max_ts is None else max(max_ts, ts)
+                        continue
+                    j = parse_line_as_json(line, verbose=False)
+                    if j is not None and 'ts' not in j.keys():
+                        metadata_events.append(j)
+                        metadata_line_numbers.append(line_number)
+
+            if rollup is not None:
+                rollup.add_lines(data[:region_len])
+
+            hit = data.find(STEP_MARKER, 0, region_len) if index_steps else -1
+            while hit != -1:
+                line_start = data.rfind(b'\n', 0, hit) + 1
+                line_end = data.index(b'\n', hit)
+                hit = data.find(STEP_MARKER, line_end, region_len)
+                line = data[line_start:line_end]
+                pid_match = PID_PATTERN.search(line)
+                if pid_match is None or STEP_PHASE_PATTERN.search(line) is None:
+                    continue
+                pid = int(pid_match.group(1))
+                if pid not in steps_by_pid:
+                    if not find_step_pid:
+                        continue
+                    if len(steps_by_pid) >= STEP_CANDIDATE_PIDS:
+                        highest_pid = max(steps_by_pid)
+                        if pid > highest_pid:
+                            continue
+                        del steps_by_pid[highest_pid]
+                    steps_by_pid[pid] = []
+                ts = ts_extractor(line, verbose=False)
+                if ts is not None:
+                    steps_by_pid[pid].append((ts, data_start + line_start))
+
+            while True:
+                if sample_start is None:
+                    if next_target >= region_end:
+                        break
+                    sample_start = data_start + data.index(b'\n', max(next_target - data_start, 0)) + 1
+                if sample_start >= region_end:
+                    # Sample line starts in the next block
+                    break
+
+                sample_end = data.index(b'\n', sample_start - data_start) + 1
+                ts = ts_extractor(data[sample_start - data_start:sample_end], verbose=False)
+                after_sample = data_start + sample_end
+                if ts is not None:
+                    index.append((ts, after_sample))
+                    min_ts = ts if min_ts is None else min(min_ts, ts)
+                    max_ts = ts if max_ts is None else max(max_ts, ts)
+
+                sample_start = None
+                while next_target < after_sample:
+                    next_target += bytes_per_index
+
+        # A grid point in the last line of the range has its sample line just past end_byte
+        if sample_start is not None and sample_start == pos and not carry:
+            line = f.readline()
+            if line.endswith(b'\n'):
+                ts = ts_extractor(line, verbose=False)
+                if ts is not None:
+                    index.append((ts, pos + len(line)))
+                    min_ts = ts if min_ts is None else min(min_ts, ts)
+                    max_ts = ts if max_ts is None else max(max_ts, ts)
+
+        scanned_checkpoints = f.checkpoints if compression else []
+
+    # Complete lines at the end of the range. The first one may be cut by the start of the tail
+    for line in tail.split(b'\n')[1:-1]:
+        ts = ts_extractor(line, verbose=False)
+        if ts is not None:
+            min_ts = ts if min_ts is None else min(min_ts, ts)
+            max_ts = ts if max_ts is None else max(max_ts, ts)
+
+    step_pid, steps = choose_step_pid(steps_by_pid)
+    return {
+        "end_byte": pos,
+        "checkpoints": scanned_checkpoints,
+        "line_count": line_count,
+        "min_ts": min_ts,
+        "max_ts": max_ts,
+        "metadata_events": metadata_events,
+        "metadata_line_numbers": metadata_line_numbers,
+        "metadata_lines_scanned": metadata_lines_scanned,
+        "index": index,
+        "step_pid": step_pid if index_steps else None,
+        "steps": steps if index_steps else None,
+        "steps_by_pid": steps_by_pid if index_steps else None,
+        "rollup": rollup,
+    }
+
+
+# Returns (step pid, its boundaries) from {pid: boundaries}: the pid with the most boundaries, the lowest on ties.
+# (None, []) if no pid negotiated
+def choose_step_pid(steps_by_pid):
+    if not steps_by_pid:
+        return None, []
+    step_pid = min(steps_by_pid, key=lambda pid: (-len(steps_by_pid[pid]), pid))
+    return step_pid, steps_by_pid[step_pid]
+
+
+# Split [start_byte, end_byte) into at most shard_count ranges. Every boundary is just after a newline so each line
+# belongs to exactly one range.
+def split_byte_range(path, start_byte, end_byte, shard_count, min_shard_bytes=SCAN_BLOCK_BYTES):
+    shard_count = max(1, min(shard_count, (end_byte - start_byte) // min_shard_bytes))
+    shard_bytes = (end_byte - start_byte) // shard_count
+
+    boundaries = [start_byte]
+    with open(path, 'rb') as f:
+        for i in range(1, shard_count):
+            f.seek(start_byte + i * shard_bytes - 1)
+            f.readline()
+            boundary = min(f.tell(), end_byte)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    if end_byte > boundaries[-1]:
+        boundaries.append(end_byte)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+# Returns (shard_id, result, JSON parse counts of the shard)
+def _run_shard(args):
+    shard_id, func, path, start_byte, end_byte, func_args = args
+    counts = dict(PARSE_COUNTS)
+    result = func(path, start_byte, end_byte, *func_args)
+    return shard_id, result, {key: PARSE_COUNTS[key] - counts[key] for key in PARSE_COUNTS}
+
+
+# Runs func(path, shard_start, shard_end, *func_args) over newline-aligned shards of [start_byte, end_byte) in a
+# process pool and returns the results in file order. func must be a module level function. func_args can also be a
+# function of (shard_start, shard_end) returning the arguments of that shard
+def map_byte_range_shards(func, path, start_byte, end_byte, workers, func_args=(), pbar=None, shards_per_worker=4):
+    shards = split_byte_range(path, start_byte, end_byte, workers * shards_per_worker)
+    args = [(i, func, path, shard_start, shard_end,
+             func_args(shard_start, shard_end) if callable(func_args) else func_args)
+            for i, (shard_start, shard_end) in enumerate(shards)]
+
+    results = [None] * len(shards)
+    with multiprocessing.Pool(min(workers, len(shards))) as pool:
+        for shard_id, result, counts in pool.imap_unordered(_run_shard, args):
+            results[shard_id] = result
+            add_parse_counts(counts)
+            if pbar is not None:
+                shard_start, shard_end = shards[shard_id]
+                pbar.update(shard_end - shard_start)
+    return results
+
+
+# Combine the results of scan_byte_range() over consecutive ranges (in file order) into the result of one scan over the
+# whole range. Metadata events are only kept if they fall in the first max_metadata_lines lines of the whole range.
+def merge_scan_results(results, max_metadata_lines):
+    merged = {
+        "end_byte": results[-1]["end_byte"],
+        "checkpoints": [],
+        "line_count": 0,
+        "min_ts": None,
+        "max_ts": None,
+        "metadata_events": [],
+        "metadata_line_numbers": [],
+        "metadata_lines_scanned": 0,
+        "index": [],
+        "steps_by_pid": {} if results[0]["steps_by_pid"] is not None else None,
+        "rollup": results[0]["rollup"],
+    }
+    for result in results[1:]:
+        if merged["rollup"] is not None:
+            merged["rollup"].merge(result["rollup"])
+    for result in results:
+        lines_before = merged["line_count"]
+        for line_number, event in zip(result["metadata_line_numbers"], result["metadata_events"]):
+            if lines_before + line_number < max_metadata_lines:
+                merged["metadata_events"].append(event)
+                merged["metadata_line_numbers"].append(lines_before + line_number)
+        merged["metadata_lines_scanned"] = min(max_metadata_lines, lines_before + result["metadata_lines_scanned"])
+
+        merged["line_count"] += result["line_count"]
+        merged["index"].extend(result["index"])
+        if result["steps_by_pid"] is not None:
+            for pid, steps in result["steps_by_pid"].items():
+                merged["steps_by_pid"].setdefault(pid, []).extend(steps)
+        if result["min_ts"] is not None:
+            merged["min_ts"] = result["min_ts"] if merged["min_ts"] is None else min(merged["min_ts"], result["min_ts"])
+            merged["max_ts"] = result["max_ts"] if merged["max_ts"] is None else max(merged["max_ts"], result["max_ts"])
+
+    merged["step_pid"], merged["steps"] = None, None
+    if merged["steps_by_pid"] is not None:
+        candidates = sorted(merged["steps_by_pid"])[:STEP_CANDIDATE_PIDS]
+        merged["steps_by_pid"] = {pid: merged["steps_by_pid"][pid] for pid in candidates}
+        merged["step_pid"], merged["steps"] = choose_step_pid(merged["steps_by_pid"])
+    return merged
+
+
+# Writes one --split chunk: the metadata header, then every line of [start_byte, end_byte) with min_ts <= ts < max_ts.
+# Returns the number of events written. Module level so chunks can be written by worker processes
+def write_split_chunk(path, start_byte, end_byte, out_path, header, min_ts, max_ts, passthrough=False,
+                      ts_extractor=extract_ts_fast, compression=None, checkpoints=None):
+    event_count = 0
+    mm = map_timeline(path, compression, checkpoints)
+    mm.madvise(mmap.MADV_SEQUENTIAL)
+    with open(out_path, 'wb', buffering=EXTRACT_WRITE_BUFFER_BYTES) as o:
+        o.write(header)
+        for line in iter_raw_lines(mm, start_byte, end_byte):
+            ts = ts_extractor(line, verbose=False)
+            if ts is None or ts < min_ts or ts >= max_ts:
+                continue
+            o.write(b',\n')
+            if passthrough:
+                o.write(strip_raw_line(line))
+            else:
+                o.write(json.dumps(parse_line_as_json(line, verbose=False)).encode())
+            event_count += 1
+        o.write(b"\n]")
+    mm.close()
+    return event_count
+
+
+# Writes the events of [start_byte, end_byte) that extract_and_save_slice() keeps, each preceded by ",\n", to out_path.
+# filters is a list of (key, set of values). Returns (events written, lines read). Module level so the parts of a large
+# extract can be written by worker processes
+def write_extract_part(path, start_byte, end_byte, out_path, min_ts, max_ts, passthrough=False, filters=(),
+                       ts_extractor=extract_ts_fast, compression=None, checkpoints=None):
+    event_count = 0
+    line_count = 0
+    mm = map_timeline(path, compression, checkpoints)
+    mm.madvise(mmap.MADV_SEQUENTIAL)
+    with open(out_path, 'wb', buffering=EXTRACT_WRITE_BUFFER_BYTES) as o:
+        for line in iter_raw_lines(mm, start_byte, end_byte):
+            line_count += 1
+            ts = ts_extractor(line, verbose=False)
+            if ts is None or ts < min_ts or ts > max_ts:
+                continue
+
+            j = None
+            if filters:
+                j = parse_line_as_json(line, verbose=False)
+                if j is None or not all(key in j and j[key] in values for key, values in filters):
+                    continue
+            o.write(b',\n')
+            if passthrough:
+                o.write(strip_raw_line(line))
+            else:
+                o.write(json.dumps(j if filters else parse_line_as_json(line, verbose=False)).encode())
+            event_count += 1
+    mm.close()
+    return event_count, line_count
+
+
+# Parallel version of scan_byte_range(). Shards are scanned in a process pool and merged in file order
+# Only shards starting in the first max_metadata_lines lines look for metadata events, the others would have theirs
+# dropped by merge_scan_results()
+def scan_byte_range_parallel(path, start_byte, end_byte, bytes_per_index, max_metadata_lines=0, workers=1, pbar=None,
+                             ts_extractor=extract_ts_fast, step_pid=None, rollup=False, index_steps=False):
+    metadata_end_byte = line_end_byte(path, start_byte, end_byte, max_metadata_lines)
+
+    def shard_args(shard_start, shard_end):
+        return (bytes_per_index, max_metadata_lines if shard_start < metadata_end_byte else 0, None, ts_extractor,
+                None, None, step_pid, rollup, index_steps)
+
+    results = map_byte_range_shards(scan_byte_range, path, start_byte, end_byte, workers, func_args=shard_args,
+                                    pbar=pbar)
+    return merge_scan_results(results, max_metadata_lines)
+
+
+# Returns the byte just after the first line_count lines of [start_byte, end_byte), or end_byte if it has fewer lines.
+# Only newlines are counted
+def line_end_byte(path, start_byte, end_byte, line_count):
+    if line_count <= 0:
+        return start_byte
+    with open(path, 'rb') as f:
+        f.seek(start_byte)
+        pos = start_byte
+        while pos < end_byte:
+            block = f.read(min(SCAN_BLOCK_BYTES, end_byte - pos))
+            if not block:
+                break
+            newlines = block.count(b'\n')
+            if newlines >= line_count:
+                offset = -1
+                for _ in range(line_count):
+                    offset = block.index(b'\n', offset + 1)
+                return pos + offset + 1
+            line_count -= newlines
+            pos += len(block)
+    return end_byte
+
+
+
+# Fixed-size histogram of durations. Buckets are log spaced (BUCKETS_PER_DOUBLING per power of two), so percentiles
+# are within a few percent of the true value and memory does not grow with the number of events.
+class DurationHistogram:
+    BUCKETS_PER_DOUBLING = 16
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, dur):
+        self.count += 1
+        self.total += dur
+        self.min = dur if self.min is None else min(self.min, dur)
+        self.max = dur if self.max is None else max(self.max, dur)
+        bucket = int(math.log2(dur) * self.BUCKETS_PER_DOUBLING) + 1 if dur > 0 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        rank = p / 100. * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                if bucket == 0:
+                    return 0
+                value = 2 ** ((bucket - 0.5) / self.BUCKETS_PER_DOUBLING)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_us": self.total,
+            "mean_us": self.mean(),
+            "min_us": self.min,
+            "p50_us": self.percentile(50),
+            "p99_us": self.percentile(99),
+            "max_us": self.max,
+        }
+
+
+# Per-operation duration statistics. B/E events are paired with a stack per (pid, tid), "X" events use their dur.
+# Durations are aggregated per activity name and per (name, pid). The zero-duration "X" markers of ranks reporting ready
+# (named by the rank, "0", "1", ...) are not operations and are skipped, as in ActivityRollup.
+#
+# To support merging the stats of consecutive byte ranges, E events that arrive with an empty stack are kept in
+# orphan_ends and the stacks that are still open at the end are kept in open_begins. merge() pairs them up.
+class OpStats:
+    def __init__(self):
+        self.by_name = {}
+        self.by_name_and_pid = {}
+        self.open_begins = {}
+        self.orphan_ends = []
+        self.events = 0
+
+    def record(self, name, pid, dur):
+        if name not in self.by_name:
+            self.by_name[name] = DurationHistogram()
+        self.by_name[name].add(dur)
+        if (name, pid) not in self.by_name_and_pid:
+            self.by_name_and_pid[(name, pid)] = DurationHistogram()
+        self.by_name_and_pid[(name, pid)].add(dur)
+
+    def add_event(self, j):
+        ph = j.get('ph')
+        if ph is None or 'ts' not in j:
+            return
+        self.events += 1
+        key = (j.get('pid'), j.get('tid'))
+        if ph == 'B':
+            self.open_begins.setdefault(key, []).append((j.get('name'), j['ts']))
+        elif ph == 'E':
+            stack = self.open_begins.get(key)
+            if stack:
+                name, begin_ts = stack.pop()
+                self.record(name, key[0], j['ts'] - begin_ts)
+            else:
+                self.orphan_ends.append((key, j['ts']))
+        elif ph == 'X':
+            name = j.get('name')
+            dur = j.get('dur', 0)
+            if dur == 0 and isinstance(name, str) and name.isdigit():
+                return
+            self.record(name, key[0], dur)
+
+    # other covers the bytes directly after self
+    def merge(self, other):
+        for key, end_ts in other.orphan_ends:
+            stack = self.open_begins.get(key)
+            if stack:
+                name, begin_ts = stack.pop()
+                self.record(name, key[0], end_ts - begin_ts)
+            else:
+                self.orphan_ends.append((key, end_ts))
+
+        for name, histogram in other.by_name.items():
+            self.by_name.setdefault(name, DurationHistogram()).merge(histogram)
+        for key, histogram in other.by_name_and_pid.items():
+            self.by_name_and_pid.setdefault(key, DurationHistogram()).merge(histogram)
+        for key, stack in other.open_begins.items():
+            self.open_begins.setdefault(key, []).extend(stack)
+        self.events += other.events
+
+
+def collect_op_stats(path, start_byte, end_byte, pbar=None, compression=None, checkpoints=None):
+    pbar_throttler = 10 * 1000
+    stats = OpStats()
+    mm = map_timeline(path, compression, checkpoints)
+    mm.madvise(mmap.MADV_SEQUENTIAL)
+    i = 0
+    pos = start_byte
+    last_pbar_byte = start_byte
+    for line in iter_raw_lines(mm, start_byte, end_byte):
+        pos += len(line)
+        i += 1
+        if pbar is not None and i % pbar_throttler == 0:
+            pbar.update(pos - last_pbar_byte)
+            last_pbar_byte = pos
+
+        j = parse_line_as_json(line, verbose=False)
+        if j is not None:
+            stats.add_event(j)
+
+    if pbar is not None:
+        pbar.update(pos - last_pbar_byte)
+    mm.close()
+    return stats
+
+
+# Level of detail summary of a timeline for --overview. B/E pairs and X events at least min_event_us long are kept as
+# spans. Shorter ones are merged into one aggregate span per (pid, tid, time bucket), holding the first start, last end,
+# and the count and busy time of each op name. B/E pairing across shards works like OpStats.
+class Overview:
+    def __init__(self, origin_ts, bucket_us, min_event_us):
+        self.origin_ts = origin_ts
+        self.bucket_us = bucket_us
+        self.min_event_us = min_event_us
+        self.spans = []
+        self.aggregates = {}
+        self.open_begins = {}
+        self.orphan_ends = []
+
+    def record(self, name, key, ts, dur):
+        if dur >= self.min_event_us:
+            self.spans.append((name, key, ts, dur))
+        else:
+            self.aggregate(name, key, ts, dur)
+
+    def aggregate(self, name, key, ts, dur):
+        bucket = (key, (ts - self.origin_ts) // self.bucket_us)
+        aggregate = self.aggregates.get(bucket)
+        if aggregate is None:
+            aggregate = self.aggregates[bucket] = [ts, ts + dur, {}]
+        else:
+            aggregate[0] = min(aggregate[0], ts)
+            aggregate[1] = max(aggregate[1], ts + dur)
+        count_and_busy = aggregate[2].setdefault(name, [0, 0])
+        count_and_busy[0] += 1
+        count_and_busy[1] += dur
+
+    def add_event(self, j):
+        ph = j.get('ph')
+        if ph is None or 'ts' not in j:
+            return
+        key = (j.get('pid'), j.get('tid'))
+        if ph == 'B':
+            self.open_begins.setdefault(key, []).append((j.get('name'), j['ts']))
+        elif ph == 'E':
+            stack = self.open_begins.get(key)
+            if stack:
+                name, begin_ts = stack.pop()
+                self.record(name, key, begin_ts, j['ts'] - begin_ts)
+            else:
+                self.orphan_ends.append((key, j['ts']))
+        elif ph == 'X':
+            self.record(j.get('name'), key, j['ts'], j.get('dur', 0))
+
+    # other covers the bytes directly after self
+    def merge(self, other):
+        for key, end_ts in other.orphan_ends:
+            stack = self.open_begins.get(key)
+            if stack:
+                name, begin_ts = stack.pop()
+                self.record(name, key, begin_ts, end_ts - begin_ts)
+            else:
+                self.orphan_ends.append((key, end_ts))
+
+        self.spans.extend(other.spans)
+        for bucket, (start, end, names) in other.aggregates.items():
+            aggregate = self.aggregates.get(bucket)
+            if aggregate is None:
+                self.aggregates[bucket] = [start, end, names]
+                continue
+            aggregate[0] = min(aggregate[0], start)
+            aggregate[1] = max(aggregate[1], end)
+            for name, (count, busy) in names.items():
+                count_and_busy = aggregate[2].setdefault(name, [0, 0])
+                count_and_busy[0] += count
+                count_and_busy[1] += busy
+        for key, stack in other.open_begins.items():
+            self.open_begins.setdefault(key, []).extend(stack)
+
+    # Double the bucket width, merging pairs of neighbouring aggregates
+    def coarsen(self):
+        aggregates = self.aggregates
+        self.aggregates = {}
+        self.bucket_us *= 2
+        for (key, bucket), (start, end, names) in aggregates.items():
+            coarse = self.aggregates.get((key, bucket // 2))
+            if coarse is None:
+                self.aggregates[(key, bucket // 2)] = [start, end, names]
+                continue
+            coarse[0] = min(coarse[0], start)
+            coarse[1] = max(coarse[1], end)
+            for name, (count, busy) in names.items():
+                count_and_busy = coarse[2].setdefault(name, [0, 0])
+                count_and_busy[0] += count
+                count_and_busy[1] += busy
+
+    # Coarsen buckets, and if there are too many long spans aggregate the shortest of them, until at most max_events
+    # events remain (or every (pid, tid) is a single bucket covering span_us)
+    def limit(self, max_events, span_us):
+        if len(self.spans) > max_events // 2:
+            self.spans.sort(key=lambda span: -span[3])
+            for name, key, ts, dur in self.spans[max_events // 2:]:
+                self.aggregate(name, key, ts, dur)
+            del self.spans[max_events // 2:]
+        while len(self.spans) + len(self.aggregates) > max_events and self.bucket_us < span_us:
+            self.coarsen()
+
+    def trace_events(self):
+        events = []
+        for name, (pid, tid), ts, dur in self.spans:
+            event = {"name": name, "ph": "X", "ts": ts, "dur": dur, "pid": pid}
+            if tid is not None:
+                event["tid"] = tid
+            events.append(event)
+        for ((pid, tid), _), (start, end, names) in self.aggregates.items():
+            event = {
+                "name": max(names.items(), key=lambda item: item[1][1])[0],
+                "cat": "aggregated",
+                "ph": "X", "ts": start, "dur": end - start, "pid": pid,
+                "args": {
+                    "events": sum(count for count, _ in names.values()),
+                    "busy_ms": round(sum(busy for _, busy in names.values()) / 1000., 3),
+                    "ops": {str(name): count for name, (count, _) in names.items()},
+                },
+            }
+            if tid is not None:
+                event["tid"] = tid
+            events.append(event)
+        events.sort(key=lambda event: event["ts"])
+        return events
+
+
+def collect_overview(path, start_byte, end_byte, origin_ts, bucket_us, min_event_us, pbar=None, compression=None,
+                     checkpoints=None):
+    pbar_throttler = 10 * 1000
+    overview = Overview(origin_ts, bucket_us, min_event_us)
+    mm = map_timeline(path, compression, checkpoints)
+    mm.madvise(mmap.MADV_SEQUENTIAL)
+    i = 0
+    pos = start_byte
+    last_pbar_byte = start_byte
+    for line in iter_raw_lines(mm, start_byte, end_byte):
+        pos += len(line)
+        i += 1
+        if pbar is not None and i % pbar_throttler == 0:
+            pbar.update(pos - last_pbar_byte)
+            last_pbar_byte = pos
+
+        j = parse_line_as_json(line, verbose=False)
+        if j is not None:
+            overview.add_event(j)
+
+    if pbar is not None:
+        pbar.update(pos - last_pbar_byte)
+    mm.close()
+    return overview
+
+
+# Returns, for each event name and pid, a bitmap (little-endian bytes) of the buckets (line start byte // bucket_bytes)
+# it appears in, where bit 0 is bucket first_bucket. Metadata events are skipped since they are written to the header of
+# every extract
+def collect_filter_buckets(path, start_byte, end_byte, bucket_bytes, pbar=None, compression=None, checkpoints=None):
+    pbar_throttler = 10 * 1000
+    names = {}
+    pids = {}
+    first_bucket = start_byte // bucket_bytes
+    bitmap_bytes = (end_byte - 1) // bucket_bytes - first_bucket + 1
+    bitmap_bytes = bitmap_bytes // 8 + 1
+    mm = map_timeline(path, compression, checkpoints)
+    mm.madvise(mmap.MADV_SEQUENTIAL)
+    i = 0
+    pos = start_byte
+    last_pbar_byte = start_byte
+    for line in iter_raw_lines(mm, start_byte, end_byte):
+        bucket = pos // bucket_bytes - first_bucket
+        pos += len(line)
+        i += 1
+        if pbar is not None and i % pbar_throttler == 0:
+            pbar.update(pos - last_pbar_byte)
+            last_pbar_byte = pos
+
+        j = parse_line_as_json(line, verbose=False)
+        if j is None or 'ts' not in j:
+            continue
+        for bitmaps, key in ((names, 'name'), (pids, 'pid')):
+            if key in j:
+                bitmap = bitmaps.get(j[key])
+                if bitmap is None:
+                    bitmap = bitmaps[j[key]] = bytearray(bitmap_bytes)
+                bitmap[bucket >> 3] |= 1 << (bucket & 7)
+
+    if pbar is not None:
+        pbar.update(pos - last_pbar_byte)
+    mm.close()
+    return {"first_bucket": first_bucket, "names": names, "pids": pids}
+
+
+
+
+
+
+
+
+
+
+
+
+
 
 
 
@@ -122,116 +1416,762 @@ def blocks(files, size=65536):
 
 
 
+# Binary sidecar for the (ts, byte) index. Layout:
+#   header: magic (8 bytes), entry count (int64), bytes_per_index (int64), checkpoint count (int64)
+#   ts column: entry count * int64
+#   byte column: entry count * int64
+#   checkpoint uncompressed offset column: checkpoint count * int64
+#   checkpoint compressed offset column: checkpoint count * int64
+# The file is memory mapped and the ts column is searched with bisect, so loading is O(1) and lookups are O(log n).
+# Checkpoints are only present for compressed timelines (see DecompressedTimeline). Files written before checkpoints
+# were added (HTIDX001, no checkpoint count) can still be loaded.
+class TimestampIndex:
+    MAGIC = b'HTIDX002'
+    HEADER = struct.Struct('<8sqqq')
+    MAGIC_V1 = b'HTIDX001'
+    HEADER_V1 = struct.Struct('<8sqq')
 
+    def __init__(self, ts_column, byte_column, bytes_per_index=0, checkpoints=None, mm=None):
+        self.ts_column = ts_column
+        self.byte_column = byte_column
+        self.bytes_per_index = bytes_per_index
+        self.checkpoints = checkpoints or []
+        self._mm = mm
 
+    @classmethod
+    def from_entries(cls, entries, bytes_per_index=0, checkpoints=None):
+        return cls(array('q', [int(ts) for ts, _ in entries]), array('q', [byte for _, byte in entries]),
+                   bytes_per_index=bytes_per_index, checkpoints=checkpoints)
 
-
-
-
-
-
-
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:8] == cls.MAGIC_V1:
+            _, count, bytes_per_index = cls.HEADER_V1.unpack_from(mm, 0)
+            checkpoint_count = 0
+            header_size = cls.HEADER_V1.size
+        elif mm[:8] == cls.MAGIC:
+            _, count, bytes_per_index, checkpoint_count = cls.HEADER.unpack_from(mm, 0)
+            header_size = cls.HEADER.size
+        else:
+            raise RuntimeError(f'{path} is not a timeline index file')
+        if len(mm) != header_size + 16 * count + 16 * checkpoint_count:
+            raise RuntimeError(f'{path} is truncated. Expected {humanize(count)} entries')
+
+        view = memoryview(mm)
+        ts_start = header_size
+        byte_start = ts_start + 8 * count
+        checkpoint_start = byte_start + 8 * count
+        checkpoint_column = view[checkpoint_start:checkpoint_start + 16 * checkpoint_count].cast('q')
+        checkpoints = list(zip(checkpoint_column[:checkpoint_count], checkpoint_column[checkpoint_count:]))
+        return cls(view[ts_start:byte_start].cast('q'), view[byte_start:checkpoint_start].cast('q'),
+                   bytes_per_index=bytes_per_index, checkpoints=checkpoints, mm=mm)
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(self), self.bytes_per_index, len(self.checkpoints)))
+            array('q', self.ts_column).tofile(f)
+            array('q', self.byte_column).tofile(f)
+            array('q', [uncompressed for uncompressed, _ in self.checkpoints]).tofile(f)
+            array('q', [compressed for _, compressed in self.checkpoints]).tofile(f)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.ts_column)
+
+    def __getitem__(self, i):
+        return self.ts_column[i], self.byte_column[i]
+
+    def __iter__(self):
+        return zip(self.ts_column, self.byte_column)
+
+    # Returns (byte_index_before, byte_index_after) around find_ts
+    def search(self, find_ts, file_size_bytes):
+        i = bisect.bisect_left(self.ts_column, find_ts)
+        byte_before = self.byte_column[i - 1] if i > 0 else 0
+        byte_after = self.byte_column[i] if i < len(self) else file_size_bytes
+        return byte_before, byte_after
+
+
+
+# Inverted index from event name and pid to the buckets (line start byte // bucket_bytes, see FILTER_BUCKET_BYTES)
+# holding them, used to skip buckets during filtered extraction. Saved as <timeline>.fidx.json with one bitset per key,
+# where bit i is set if bucket i has the key, as base64 of the zlib compressed little-endian bytes (hex strings in
+# indexes built before). Bytes past covered_bytes (appended after the build) are always scanned. A loaded index keeps
+# the bitsets encoded and decodes those of a key the first time a filter asks for it
+class FilterIndex:
+
+    def __init__(self, bucket_bytes, covered_bytes=0, names=None, pids=None, encoding="zlib"):
+        self.bucket_bytes = bucket_bytes
+        self.covered_bytes = covered_bytes
+        self.names = names or {}
+        self.pids = pids or {}
+        self.encoding = encoding
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            j = json.load(f)
+        return cls(j["bucket_bytes"], j["covered_bytes"], names=j["names"],
+                   pids={int(pid): bits for pid, bits in j["pids"].items()}, encoding=j.get("encoding", "hex"))
+
+    def decode(self, bits):
+        if not isinstance(bits, str):
+            return bits
+        if self.encoding == "zlib":
+            return int.from_bytes(zlib.decompress(base64.b64decode(bits)), 'little')
+        return int(bits, 16)
+
+    # Returns the bitset of key in bits_by_key (self.names or self.pids), decoding it if needed
+    def key_bits(self, bits_by_key, key):
+        bits = bits_by_key.get(key, 0)
+        if isinstance(bits, str):
+            bits = bits_by_key[key] = self.decode(bits)
+        return bits
+
+    def decode_all(self):
+        for bits_by_key in (self.names, self.pids):
+            for key in bits_by_key:
+                self.key_bits(bits_by_key, key)
+
+    def save(self, path):
+        self.decode_all()
+
+        def encode(bits):
+            return base64.b64encode(zlib.compress(bits.to_bytes((bits.bit_length() + 7) // 8, 'little'))).decode()
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w+') as f:
+            json.dump({
+                "bucket_bytes": self.bucket_bytes,
+                "covered_bytes": self.covered_bytes,
+                "encoding": "zlib",
+                "names": {name: encode(bits) for name, bits in self.names.items()},
+                "pids": {pid: encode(bits) for pid, bits in self.pids.items()},
+            }, f)
+        os.replace(tmp_path, path)
+        self.encoding = "zlib"
+
+    # Merge the result of collect_filter_buckets()
+    def add(self, buckets):
+        for bits_by_key, bitmaps in ((self.names, buckets["names"]), (self.pids, buckets["pids"])):
+            for key, bitmap in bitmaps.items():
+                bits_by_key[key] = (self.key_bits(bits_by_key, key) |
+                                    (int.from_bytes(bitmap, 'little') << buckets["first_bucket"]))
+
+    # Bitset of the buckets that may hold events matching every given filter, or None if nothing is filtered. A bucket
+    # matches a filter if it holds any of its values.
+    def candidate_buckets(self, pids=None, names=None):
+        bits = None
+        for bits_by_key, values in ((self.pids, pids), (self.names, names)):
+            if values is None:
+                continue
+            key_bits = 0
+            for value in values:
+                key_bits |= self.key_bits(bits_by_key, value)
+            bits = key_bits if bits is None else bits & key_bits
+        return bits
+
+    # The parts of [start_byte, end_byte) that may hold matching events, as sorted (start, end) byte ranges on bucket
+    # boundaries. Callers align them to lines
+    def byte_ranges(self, start_byte, end_byte, pids=None, names=None):
+        bits = self.candidate_buckets(pids=pids, names=names)
+        if bits is None:
+            return [(start_byte, end_byte)]
+
+        ranges = []
+        covered_end = min(end_byte, self.covered_bytes)
+        first_bucket = start_byte // self.bucket_bytes
+        bucket_count = max((covered_end - 1) // self.bucket_bytes + 1 - first_bucket, 0)
+        # Only the window's buckets, as bytes so each bit test is constant time however large the file is
+        window_bits = ((bits >> first_bucket) & ((1 << bucket_count) - 1)).to_bytes((bucket_count + 7) // 8, 'little')
+        for i in range(bucket_count):
+            if not (window_bits[i >> 3] >> (i & 7)) & 1:
+                continue
+            bucket = first_bucket + i
+            range_start = max(bucket * self.bucket_bytes, start_byte)
+            range_end = min((bucket + 1) * self.bucket_bytes, covered_end)
+            if ranges and ranges[-1][1] == range_start:
+                ranges[-1] = (ranges[-1][0], range_end)
+            else:
+                ranges.append((range_start, range_end))
+        if end_byte > self.covered_bytes:
+            ranges.append((max(start_byte, self.covered_bytes), end_byte))
+        return ranges
+
+
+# Returns (head hash, tail hash) of the first size bytes of the file at path: the hashes of its first and last
+# FINGERPRINT_BLOCK_BYTES. Reads at most two blocks, however large the file is. A file that was appended to keeps the
+# fingerprint of its old size
+def timeline_fingerprint(path, size):
+    with open(path, 'rb') as f:
+        head = f.read(min(FINGERPRINT_BLOCK_BYTES, size))
+        tail_start = max(size - FINGERPRINT_BLOCK_BYTES, 0)
+        f.seek(tail_start)
+        tail = f.read(size - tail_start)
+    return hashlib.sha1(head).hexdigest()[:16], hashlib.sha1(tail).hexdigest()[:16]
+
+
+# Central directory of timeline metadata (.sum.json, .idx, ...), for timelines in read-only or shared directories and
+# so copies of a timeline on other hosts or under other names reuse one index. Each timeline has an entry directory
+# named <head hash>-<size>-<tail hash> (see timeline_fingerprint) holding its sidecar files. A timeline that grew since
+# its entry was built is matched by the entry of its old size, whose tail hash still matches at that size, so only
+# the appended bytes are scanned. Entries are bumped on use, and the least recently used are deleted until the cache
+# fits in max_bytes.
+class IndexCache:
+
+    def __init__(self, directory, max_bytes=INDEX_CACHE_BYTES):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_name(self, path, size):
+        head, tail = timeline_fingerprint(path, size)
+        return f'{head}-{size}-{tail}'
+
+    # Returns the entry directory for the first size bytes of path: an exact match, else the largest entry of a
+    # prefix of the file, else a new empty entry
+    def lookup(self, path, size):
+        name = self.entry_name(path, size)
+        head = name.split("-")[0]
+        entry = os.path.join(self.directory, name)
+        if not os.path.isdir(entry):
+            prefixes = []
+            for candidate in os.scandir(self.directory):
+                parts = candidate.name.split("-")
+                if len(parts) == 3 and parts[0] == head and parts[1].isdigit() and int(parts[1]) < size:
+                    prefixes.append((int(parts[1]), candidate.name))
+            for prefix_size, candidate_name in sorted(prefixes, reverse=True):
+                if self.entry_name(path, prefix_size) == candidate_name:
+                    entry = os.path.join(self.directory, candidate_name)
+                    break
+            else:
+                os.makedirs(entry, exist_ok=True)
+        os.utime(entry)
+        return entry
+
+    # Renames entry to the fingerprint of the first size bytes of path once its metadata covers them. Returns the
+    # entry's new directory
+    def update(self, entry, path, size):
+        new_entry = os.path.join(self.directory, self.entry_name(path, size))
+        if new_entry != entry:
+            try:
+                os.rename(entry, new_entry)
+            except OSError:
+                # Another process built the entry for this content. Ours is evicted in time
+                return entry
+        return new_entry
+
+    def entry_bytes(self, entry):
+        return sum(f.stat().st_size for f in os.scandir(entry) if f.is_file())
+
+    def evict(self, keep=None):
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.is_dir()),
+                         key=lambda entry: entry.stat().st_mtime)
+        sizes = {entry.path: self.entry_bytes(entry.path) for entry in entries}
+        total_bytes = sum(sizes.values())
+        for entry in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if entry.path == keep:
+                continue
+            total_bytes -= sizes[entry.path]
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+
+
+# Returns the lengths of the lines of block (bytes) and their ts, and how far the ts go back, i.e. the largest amount by
+# which a ts is smaller than one before it. With partial_first=True the first line is skipped
+def block_ts(block, ts_extractor, partial_first=False):
+    lines = block.split(b'\n')
+    if partial_first:
+        lines = lines[1:]
+    timestamps = [ts for ts in (ts_extractor(line, verbose=False) for line in lines) if ts is not None]
+    jitter = 0
+    running_max = None
+    for ts in timestamps:
+        running_max = ts if running_max is None else max(running_max, ts)
+        jitter = max(jitter, running_max - ts)
+    return timestamps, jitter
+
+
+# Returns the line of the file f (of size bytes) that holds byte offset, without its newline, and the bytes read
+def line_at(f, offset, size):
+    window = APPROX_READ_BYTES
+    while True:
+        start = max(offset - window, 0)
+        end = min(offset + window, size)
+        f.seek(start)
+        block = f.read(end - start)
+        line_start = block.rfind(b'\n', 0, offset - start) + 1
+        line_end = block.find(b'\n', offset - start)
+        if (line_start > 0 or start == 0) and (line_end != -1 or end == size):
+            return block[line_start:line_end if line_end != -1 else len(block)], len(block)
+        window *= 2
+
+
+# Estimates the line count, event count, duration and event rate of an uncompressed timeline without scanning it.
+# Duration comes from the first and last TAIL_BYTES. Its bounds are a heuristic, not a confidence interval: events
+# written out of order by up to the largest gap seen there may extend it, which gives the upper bound. Counts come from
+# the lines holding `samples` random offsets. A line is hit with probability length / file size, so file size / length
+# averages to the line count, and the same with 0 for lines without a ts to the event count. Intervals are normal
+# confidence intervals of those means.
+def approximate_stats(path, samples=APPROX_SAMPLES, ts_extractor=extract_ts_fast, seed=None):
+    if compression_for_path(path) is not None:
+        raise RuntimeError(f'--approx needs an uncompressed timeline, {path} is compressed')
+    start = time.time()
+    size = os.stat(path).st_size
+    if size == 0:
+        raise RuntimeError(f'{path} is empty')
+    r = random.Random(seed)
+    bytes_read = 0
+    line_estimates = []
+    event_estimates = []
+    with open(path, 'rb') as f:
+        head = f.read(TAIL_BYTES)
+        f.seek(max(size - TAIL_BYTES, 0))
+        tail = f.read(TAIL_BYTES)
+        bytes_read += len(head) + len(tail)
+        head_ts, head_jitter = block_ts(head, ts_extractor)
+        tail_ts, tail_jitter = block_ts(tail, ts_extractor, partial_first=size > TAIL_BYTES)
+        if not head_ts or not tail_ts:
+            raise RuntimeError(f'No timestamped events found in the first or last {humanize_bytes(TAIL_BYTES)} '
+                               f'of {path}')
+
+        # Sorted so the reads move forward through the file
+        for offset in sorted(r.randrange(size) for _ in range(samples)):
+            line, line_bytes_read = line_at(f, offset, size)
+            bytes_read += line_bytes_read
+            length = len(line) + 1
+            line_estimates.append(size / length)
+            event_estimates.append(size / length if ts_extractor(line, verbose=False) is not None else 0)
+
+    # Returns the mean of estimates and its (low, high)
+    def interval(estimates):
+        mean = sum(estimates) / len(estimates)
+        variance = sum((estimate - mean) ** 2 for estimate in estimates) / max(len(estimates) - 1, 1)
+        error = APPROX_Z * math.sqrt(variance / len(estimates))
+        return mean, (max(mean - error, 0), mean + error)
+
+    duration_secs = (max(tail_ts) - min(head_ts)) / MICROSECONDS_PER_SEC
+    jitter_secs = max(head_jitter, tail_jitter) / MICROSECONDS_PER_SEC
+    line_count, line_interval = interval(line_estimates)
+    event_count, event_interval = interval(event_estimates)
+    duration_bounds = (duration_secs, duration_secs + 2 * jitter_secs)
+    return {
+        "path": path,
+        "file_size": size,
+        "samples": samples,
+        "bytes_read": bytes_read,
+        "seconds": time.time() - start,
+        "mean_line_bytes": size / line_count,
+        "duration_secs": duration_secs,
+        "duration_bounds": duration_bounds,
+        "line_count": line_count,
+        "line_interval": line_interval,
+        "event_count": event_count,
+        "event_interval": event_interval,
+        "events_per_sec": event_count / max(duration_secs, 1e-9),
+        "events_per_sec_interval": (event_interval[0] / max(duration_bounds[1], 1e-9),
+                                    event_interval[1] / max(duration_bounds[0], 1e-9)),
+    }
+
+
+def print_approximate_stats(stats):
+    print(f'Approximate stats of {stats["path"]} from {humanize(stats["samples"])} sampled lines '
+          f'({humanize_bytes(stats["bytes_read"])} read in {humanize_float(stats["seconds"])}s). '
+          f'Line and event ranges are 95% confidence intervals')
+    print("")
+    print(f'File size: {humanize_bytes(stats["file_size"])}')
+    low, high = stats["duration_bounds"]
+    print(f'Timeline Duration: {humanize_float(stats["duration_secs"])} seconds '
+          f'(heuristic bounds for out of order events: {humanize_float(low)} to {humanize_float(high)})')
+    for label, key in (("Lines", "line"), ("Events", "event")):
+        low, high = stats[f'{key}_interval']
+        print(f'{label}: ~{humanize(int(stats[f"{key}_count"]))} ({humanize(int(low))} to {humanize(int(high))})')
+    low, high = stats["events_per_sec_interval"]
+    print(f'Event rate: ~{humanize(int(stats["events_per_sec"]))} events/s '
+          f'({humanize(int(low))} to {humanize(int(high))}, the event interval over the duration bounds)')
+    print(f'Mean line length: {humanize_float(stats["mean_line_bytes"])} bytes')
+
+
+# Writer backends of extract_and_save_slice(). write() takes a decoded event, or the raw line bytes of a passthrough
+# extract (JSON only)
+class JsonTraceWriter:
+    EXTENSION = ".json"
+
+    def __init__(self, f, metadata_events):
+        self.f = f
+        self.f.write(("[" + ",".join(f'\n{json.dumps(metadata_event)}' for metadata_event in metadata_events)).encode())
+
+    def write(self, event):
+        if isinstance(event, bytes):
+            self.f.write(b',\n')
+            self.f.write(event)
+        else:
+            self.f.write(f',\n{json.dumps(event)}'.encode())
+
+    def close(self):
+        self.f.write(b"\n]")
+
+
+# Protobuf encoding, by hand so no protobuf module is needed
+def _varint(value):
+    value &= 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _varint_field(field, value):
+    return _varint(field << 3) + _varint(value)
+
+def _bytes_field(field, data):
+    if isinstance(data, str):
+        data = data.encode()
+    return _varint(field << 3 | 2) + _varint(len(data)) + data
+
+def _double_field(field, value):
+    return _varint(field << 3 | 1) + struct.pack('<d', value)
+
+
+# Streams events into a Perfetto protobuf trace (see perfetto's trace_packet.proto and track_event.proto). Every pid
+# gets a process track named by its process_name metadata event, and every (pid, tid) a thread track under it. B/E
+# events become slice begin/end, X events a begin/end pair and i/I events instants. Event names, categories and arg
+# names are interned: each string is written once on the sequence and then referenced by id. Events without a "cat"
+# get the op category of the activity rollup. ts is converted from microseconds to nanoseconds.
+class PerfettoTraceWriter:
+    EXTENSION = ".pftrace"
+    SEQUENCE_ID = 1
+    SEQ_INCREMENTAL_STATE_CLEARED = 1
+    SEQ_NEEDS_INCREMENTAL_STATE = 2
+    TYPE_SLICE_BEGIN = 1
+    TYPE_SLICE_END = 2
+    TYPE_INSTANT = 3
+
+    def __init__(self, f, metadata_events):
+        self.f = f
+        self.sequence_flags = self.SEQ_INCREMENTAL_STATE_CLEARED
+        self.tracks = {}
+        self.process_names = {}
+        self.thread_names = {}
+        # Interned strings per InternedData field: event_categories (1), event_names (2), debug_annotation_names (3)
+        self.interned = {1: {}, 2: {}, 3: {}}
+        for metadata_event in metadata_events:
+            name = metadata_event.get('args', {}).get('name')
+            if name is None:
+                continue
+            if metadata_event.get('name') == "process_name":
+                self.process_names[metadata_event.get('pid')] = str(name)
+            elif metadata_event.get('name') == "thread_name":
+                self.thread_names[(metadata_event.get('pid'), metadata_event.get('tid'))] = str(name)
+        for pid in self.process_names:
+            self.track_uuid(pid, None)
+
+    def write_packet(self, body):
+        body += _varint_field(10, self.SEQUENCE_ID)
+        self.f.write(_bytes_field(1, body))
+
+    def track_uuid(self, pid, tid):
+        uuid = self.tracks.get((pid, tid))
+        if uuid is not None:
+            return uuid
+        parent_uuid = self.track_uuid(pid, None) if tid is not None else None
+        uuid = self.tracks[(pid, tid)] = len(self.tracks) + 1
+
+        descriptor = _varint_field(1, uuid)
+        if tid is None and isinstance(pid, int):
+            process = _varint_field(1, pid)
+            if pid in self.process_names:
+                process += _bytes_field(6, self.process_names[pid])
+            descriptor += _bytes_field(3, process)
+        elif tid is None:
+            descriptor += _bytes_field(2, str(pid))
+        else:
+            descriptor += _varint_field(5, parent_uuid)
+            if isinstance(pid, int) and isinstance(tid, int):
+                thread = _varint_field(1, pid) + _varint_field(2, tid)
+                if (pid, tid) in self.thread_names:
+                    thread += _bytes_field(5, self.thread_names[(pid, tid)])
+                descriptor += _bytes_field(4, thread)
+            else:
+                descriptor += _bytes_field(2, self.thread_names.get((pid, tid), str(tid)))
+        self.write_packet(_bytes_field(60, descriptor))
+        return uuid
+
+    # Returns the iid of name in an interned table, adding a new entry to new_entries
+    def intern(self, field, name, new_entries):
+        table = self.interned[field]
+        iid = table.get(name)
+        if iid is None:
+            iid = table[name] = len(table) + 1
+            new_entries.append(_bytes_field(field, _varint_field(1, iid) + _bytes_field(2, name)))
+        return iid
+
+    def annotation(self, name, value, new_entries):
+        annotation = _varint_field(1, self.intern(3, name, new_entries))
+        if isinstance(value, bool):
+            return annotation + _varint_field(2, value)
+        if isinstance(value, int):
+            return annotation + _varint_field(4, value)
+        if isinstance(value, float):
+            return annotation + _double_field(5, value)
+        if isinstance(value, str):
+            return annotation + _bytes_field(6, value)
+        return annotation + _bytes_field(6, json.dumps(value))
+
+    def track_event(self, event_type, ts, uuid, event=None):
+        new_entries = []
+        track_event = _varint_field(9, event_type) + _varint_field(11, uuid)
+        if event is not None:
+            name = str(event.get('name', ""))
+            category = str(event.get('cat') or op_category(name))
+            track_event += _varint_field(3, self.intern(1, category, new_entries))
+            track_event += _varint_field(10, self.intern(2, name, new_entries))
+            args = event.get('args')
+            if isinstance(args, dict):
+                for key, value in args.items():
+                    track_event += _bytes_field(4, self.annotation(str(key), value, new_entries))
+
+        body = _varint_field(8, int(ts * 1000)) + _bytes_field(11, track_event)
+        if new_entries:
+            body += _bytes_field(12, b''.join(new_entries))
+        body += _varint_field(13, self.sequence_flags | self.SEQ_NEEDS_INCREMENTAL_STATE)
+        self.sequence_flags = 0
+        self.write_packet(body)
+
+    def write(self, event):
+        ph = event.get('ph')
+        ts = event.get('ts')
+        if ts is None:
+            return
+        uuid = self.track_uuid(event.get('pid'), event.get('tid'))
+        if ph == 'B':
+            self.track_event(self.TYPE_SLICE_BEGIN, ts, uuid, event)
+        elif ph == 'E':
+            self.track_event(self.TYPE_SLICE_END, ts, uuid)
+        elif ph == 'X':
+            self.track_event(self.TYPE_SLICE_BEGIN, ts, uuid, event)
+            self.track_event(self.TYPE_SLICE_END, ts + event.get('dur', 0), uuid)
+        elif ph in ('i', 'I'):
+            self.track_event(self.TYPE_INSTANT, ts, uuid, event)
+
+    def close(self):
+        pass
+
+
+TRACE_WRITERS = {
+    "json": JsonTraceWriter,
+    "perfetto": PerfettoTraceWriter,
+}
 
 
 class HorovodTimeline:
 
     def __init__(self, relpath, max_lines_to_scan_for_metadata=5 * 1000 * 1000, bytes_per_index=None, secs_per_index=1,
-                 build_new_summary=False, max_extract_time=None, verbose=False, live=False):
+                 build_new_summary=False, max_extract_time=None, verbose=False, live=False, workers=1,
+                 ts_extractor=extract_ts_fast, profiler=None, rollup=False, index_cache_dir=None,
+                 index_cache_bytes=INDEX_CACHE_BYTES, index_steps=False):
 
         init_start_time = time.time()
+        self.profiler = profiler or Profiler()
+        # Whether to build the per-second activity rollup (see ActivityRollup). It looks at every line, so it is only
+        # built when asked for: by the metadata scan, or by one more pass if the metadata exists without it
+        self.rollup = rollup
+        # Whether to build the training step index, the same way. step_window() also builds it on first use
+        self.index_steps = index_steps
 
         self.path = os.path.abspath(relpath)
-
-        self.base_path = self.path.replace(".json", "")
-        self.summary_json_path = self.base_path + ".sum.json"
-
+        self.compression = compression_for_path(self.path)
+        self.checkpoints = []
+        self.workers = workers
+        if self.compression is not None and workers > 1:
+            print(f'{self.compression} compressed timelines are scanned by a single process')
+            self.workers = 1
+        # Strategy for reading the ts of a line. Must be a module level function so it can be sent to worker processes
+        self.ts_extractor = TS_EXTRACTORS[ts_extractor] if isinstance(ts_extractor, str) else ts_extractor
+
+        self.base_path = os.path.splitext(self.path)[0] if self.compression else self.path
+        self.base_path = self.base_path.replace(".json", "")
 
         self.min_ts = None
         self.max_ts = None
         self.duration_secs = None
         self.line_count = 0
-        self.file_size_bytes = os.stat(self.path).st_size
+        # Step boundaries as (ts, line start byte) of step 0, 1, ... None until the step index is built
+        self.step_index = None
+        self.step_pid = None
+        # file_size_bytes is the size of the timeline's (decompressed) content. disk_size_bytes is used to notice changes
+        self.disk_size_bytes = os.stat(self.path).st_size
+        self.file_size_bytes = self.disk_size_bytes
+
+        # Sidecar files live next to the timeline, or in an entry of the shared index cache
+        index_cache_dir = index_cache_dir or os.environ.get(INDEX_CACHE_ENV)
+        self.index_cache = IndexCache(index_cache_dir, index_cache_bytes) if index_cache_dir else None
+        self.index_cache_entry = None
+        if self.index_cache is not None:
+            self.index_cache_entry = self.index_cache.lookup(self.path, self.disk_size_bytes)
+            self.set_metadata_base(os.path.join(self.index_cache_entry, "timeline"))
+        else:
+            self.set_metadata_base(self.base_path)
 
         # What summaries need to be changed?
         build_new_line_count = False
         build_new_metadata = False
         build_new_index = False
+        append_new_data = False
         summary_json_has_changed = False
 
         print(f'LOADING HOROVOD TIMELINE')
 
+        summary_load = self.profiler.start("summary_load")
         if os.path.exists(self.summary_json_path) and not build_new_summary:
             with open(self.summary_json_path, 'r') as summary_json_file:
                 summary = json.load(summary_json_file)
 
                 previous_file_size = summary["file_size"]
+                if self.compression is not None:
+                    self.file_size_bytes = summary["uncompressed_size"]
                 self.line_count = summary["line_count"]
                 self.min_ts = summary["min_ts"]
                 self.max_ts = summary["max_ts"]
                 self.duration_secs = (self.max_ts - self.min_ts) / MICROSECONDS_PER_SEC
-                self.index = summary["index"]
                 self.metadata_events = summary["metadata_events"]
 
+                if "index" in summary:
+                    # Summary from before the index moved to its own binary file
+                    self.index = TimestampIndex.from_entries(summary["index"])
+                    self.index.save(self.index_path)
+                    summary_json_has_changed = True
+
+                if os.path.exists(self.index_path):
+                    self.index = TimestampIndex.load(self.index_path)
+                    self.checkpoints = self.index.checkpoints
+                else:
+                    build_new_index = True
+
+                self.step_pid = summary.get("step_pid")
+                if os.path.exists(self.step_index_path):
+                    self.step_index = TimestampIndex.load(self.step_index_path)
+
+                # A different timeline under the same name, even of the same size. Summaries from before fingerprints
+                # were stored are only checked by size
+                fingerprint = summary.get("fingerprint")
+                if (fingerprint is not None and self.disk_size_bytes >= previous_file_size and
+                        tuple(fingerprint) != timeline_fingerprint(self.path, previous_file_size)):
+                    build_new_line_count = True
+                    build_new_metadata = True
+                    build_new_index = True
+
                 # lazily update summary
-                if self.file_size_bytes != previous_file_size:
+                elif self.disk_size_bytes != previous_file_size:
 
-                    if self.file_size_bytes < previous_file_size:
+                    if self.disk_size_bytes < previous_file_size or self.compression is not None:
                         # Something is very wrong. Perhaps new timeline reusing file name.
                         # Rebuild metadata from scratch
                         build_new_line_count = True
                         build_new_metadata = True
                         build_new_index = True
 
-                    # Update if extract would include time not currently indexed
-                    if max_extract_time:
-                        max_extract_ms = max_extract_time * MICROSECONDS_PER_SEC
-                        if max_extract_ms > self.max_ts:
-                            build_new_line_count = True
-                            build_new_index = True
+                    # Update if extract would include time not currently indexed. Only the appended bytes are scanned
+                    if max_extract_time is not None:
+                        # max_extract_time is in seconds from the start of the timeline
+                        max_extract_us = self.min_ts + max_extract_time * MICROSECONDS_PER_SEC
+                        if max_extract_us > self.max_ts:
+                            append_new_data = True
 
                     # Update if '--live' flag is passed in and file has grown
                     if live:
-                        build_new_line_count = True
-                        build_new_index = True
+                        append_new_data = True
+
+            # Summaries without min_ts_origin may hold the lowest ts of the scanned lines as min_ts, which moves every
+            # --start_time window. Only the first lines are read to restore the first-line origin
+            if summary.get("min_ts_origin") != MIN_TS_ORIGIN and not build_new_metadata:
+                self.min_ts = self.find_first_ts()
+                self.duration_secs = (self.max_ts - self.min_ts) / MICROSECONDS_PER_SEC
+                summary_json_has_changed = True
 
         else:
             build_new_line_count = True
             build_new_metadata = True
             build_new_index = True
+        summary_load.stop(bytes_read=sum(os.stat(path).st_size for path in (self.summary_json_path, self.index_path)
+                                         if os.path.exists(path) and not build_new_summary))
 
-        if build_new_line_count:
-            print("Scanning file for statistics")
-            self.line_count, self.min_ts, self.max_ts = self.summarize(verbose=verbose)
-            self.duration_secs = (self.max_ts - self.min_ts) / MICROSECONDS_PER_SEC
+        if self.compression is not None and (build_new_line_count or build_new_metadata or build_new_index):
+            print(f'Decompressing {self.compression} timeline for statistics, metadata, index and checkpoints')
+            self.build_compressed(max_lines_to_scan_for_metadata, bytes_per_index, secs_per_index, verbose=verbose)
             summary_json_has_changed = True
 
-        if build_new_metadata:
-            print(f'Scanning first {humanize(max_lines_to_scan_for_metadata)} events for metadata events')
-            self.metadata_events = self.find_metadata_events(max_lines_to_scan_for_metadata, verbose=verbose)
-            summary_json_has_changed = True
+        elif build_new_line_count or build_new_metadata or build_new_index:
+            print("Scanning file for statistics, metadata and index")
+            self.min_ts, self.max_ts = self.find_min_max_ts()
+            self.duration_secs = (self.max_ts - self.min_ts) / MICROSECONDS_PER_SEC
 
-        if build_new_index:
-            print(f'Building index')
             if bytes_per_index is None:
                 if secs_per_index is None:
                     raise RuntimeError("One of bytes_per_index or secs_per_index must be not None")
                 jumps = self.duration_secs / secs_per_index
-                bytes_per_index = int(self.file_size_bytes / jumps)
+                bytes_per_index = max(int(self.file_size_bytes / jumps), 1) if jumps > 0 else self.file_size_bytes
 
-            self.index = self.build_index(bytes_per_index, verbose=verbose)
+            metadata_lines = max_lines_to_scan_for_metadata if build_new_metadata else 0
+            scan = self.scan(bytes_per_index, metadata_lines, rollup=self.rollup, index_steps=self.index_steps,
+                             verbose=verbose)
+
+            self.line_count = scan["line_count"]
+            if scan["max_ts"] is not None:
+                self.max_ts = max(self.max_ts, scan["max_ts"])
+                self.duration_secs = (self.max_ts - self.min_ts) / MICROSECONDS_PER_SEC
+            if build_new_metadata:
+                self.metadata_events = scan["metadata_events"]
+            self.index = TimestampIndex.from_entries(scan["index"], bytes_per_index=bytes_per_index)
+            self.index.save(self.index_path)
+            self.index = TimestampIndex.load(self.index_path)
+            self.save_step_index(scan["step_pid"], scan["steps"])
+            self.save_rollup(scan["rollup"])
+            summary_json_has_changed = True
+
+        elif append_new_data and self.file_size_bytes > previous_file_size:
+            print(f'Scanning {humanize_bytes(self.file_size_bytes - previous_file_size)} appended since last load')
+            self.append(previous_file_size, verbose=verbose)
             summary_json_has_changed = True
 
 
+        # The optional name/pid index only stays valid while the timeline is appended to
+        if build_new_index and os.path.exists(self.filter_index_path):
+            os.remove(self.filter_index_path)
+
+        # Entries added to the index by refine_index(), kept apart so the main index is never rewritten by extracts.
+        # Byte offsets stay valid while the timeline is appended to
+        if build_new_index and os.path.exists(self.refined_index_path):
+            os.remove(self.refined_index_path)
+        self.refined_index = None
+        self.refine_lock = threading.Lock()
+        if os.path.exists(self.refined_index_path):
+            self.refined_index = TimestampIndex.load(self.refined_index_path)
+        # Loaded by load_filter_index() when an extract is filtered, so unfiltered runs never read it
+        self.filter_index = None
+        self.filter_index_loaded = False
+
         if summary_json_has_changed:
-            with open(self.summary_json_path, 'w+') as summary_json_file:
-                json.dump({
-                    "line_count": self.line_count,
-                    "min_ts": self.min_ts,
-                    "max_ts": self.max_ts,
-                    "index": self.index,
-                    "metadata_events": self.metadata_events,
-                    "file_size": self.file_size_bytes
-                }, summary_json_file, indent=4)
+            self.save_summary()
+
+        build_rollup = self.rollup and not os.path.exists(self.rollup_path)
+        build_step_index = self.index_steps and self.step_index is None
+        if build_rollup or build_step_index:
+            self.build_rollup_and_step_index(rollup=build_rollup, index_steps=build_step_index, verbose=verbose)
+
+        # A single gzip member or zstd frame has no restart point past the start (its end may be recorded as one)
+        if self.compression is not None and not any(0 < uncompressed_offset < self.file_size_bytes
+                                                    for uncompressed_offset, _ in self.checkpoints):
+            print(f'WARNING: {self.path} has no {self.compression} checkpoint past the start, so seeking is disabled '
+                  f'and every extract decompresses it from the beginning. Recompress it with '
+                  f'{"bgzip" if self.compression == "gzip" else "pzstd"} to get restart points')
         print("HOROVOD TIMELINE LOAD COMPLETE")
         init_end_time = time.time()
 
@@ -245,6 +2185,40 @@ class HorovodTimeline:
                 print(f'Timeline Duration: {humanize_float(self.duration_secs)} seconds')
             print(f'Time taken (Init new): {humanize_float(init_end_time - init_start_time)}s')
 
+    # Sets the paths of the sidecar files to metadata_base + extension
+    def set_metadata_base(self, metadata_base):
+        self.summary_json_path = metadata_base + ".sum.json"
+        self.index_path = metadata_base + ".idx"
+        self.filter_index_path = metadata_base + ".fidx.json"
+        self.step_index_path = metadata_base + ".steps.idx"
+        self.rollup_path = metadata_base + ".rollup.json"
+        self.refined_index_path = metadata_base + ".refine.idx"
+
+    # Writes the summary (.sum.json) from the current metadata
+    def save_summary(self):
+        summary = {
+            "line_count": self.line_count,
+            "min_ts": self.min_ts,
+            "max_ts": self.max_ts,
+            "metadata_events": self.metadata_events,
+            "file_size": self.disk_size_bytes,
+            "fingerprint": timeline_fingerprint(self.path, self.disk_size_bytes),
+            "step_pid": self.step_pid,
+            "min_ts_origin": MIN_TS_ORIGIN,
+        }
+        if self.compression is not None:
+            summary["uncompressed_size"] = self.file_size_bytes
+        # Written to a temporary file first, as other processes may share the summary through the index cache
+        tmp_path = self.summary_json_path + ".tmp"
+        with open(tmp_path, 'w+') as summary_json_file:
+            json.dump(summary, summary_json_file, indent=4)
+        os.replace(tmp_path, self.summary_json_path)
+
+        if self.index_cache is not None:
+            self.index_cache_entry = self.index_cache.update(self.index_cache_entry, self.path, self.disk_size_bytes)
+            self.set_metadata_base(os.path.join(self.index_cache_entry, "timeline"))
+            self.index_cache.evict(keep=self.index_cache_entry)
+
     def print_file_size(self):
         if self.file_size_bytes // 1000 == 0:
             print(f'File size: {humanize(self.file_size_bytes)} bytes')
@@ -279,6 +2253,10 @@ class HorovodTimeline:
         # print(f'Average ts index gap is {humanize_float(average_diff)} microseconds')
         # print(f'Average ts index gap is {humanize_float(average_diff/1000.)}ms')
         print(f'Average time between indices is {humanize_float(average_diff/MICROSECONDS_PER_SEC)}s')
+        if self.refined_index is not None:
+            print(f'{humanize(len(self.refined_index))} indices added by refinement around extracted windows')
+        if self.index_cache_entry is not None:
+            print(f'Index files in {self.index_cache_entry}')
 
     def summarize(self, verbose=False):
 
@@ -288,6 +2266,7 @@ class HorovodTimeline:
             print(f'Finding min timestamp, max timestamp and counting lines')
             time.sleep(0.1)
 
+        phase = self.profiler.start("summarize")
         start_ts = time.time()
         with open(self.path, "r", encoding="utf-8", errors='ignore') as f:
 
@@ -326,6 +2305,7 @@ class HorovodTimeline:
                     max_ts = max(ts, max_ts)
 
         end_ts = time.time()
+        phase.stop(bytes_read=self.file_size_bytes, lines=lc)
 
         if verbose:
             time.sleep(0.1)
@@ -347,6 +2327,7 @@ class HorovodTimeline:
             print(f'Scanning first {humanize(max_lines_to_scan)} lines for metadata events:')
         time.sleep(0.1)
 
+        phase = self.profiler.start("find_metadata_events")
         start_ts = time.time()
         with tqdm(total=max_lines_to_scan) as pbar:
             with open(self.path, 'r') as f:
@@ -364,12 +2345,225 @@ class HorovodTimeline:
                         break
 
         end_ts = time.time()
+        phase.stop(lines=pbar_count)
         if verbose:
             time.sleep(0.1)
             print(f'Time taken (Find metadata): {"%.2f" % (end_ts - start_ts)}s')
         return [self.parse_line_as_json(result[1]) for result in results]
 
 
+    # Cheap probe of the head and tail of the file. Same approach as summarize() but without the line count
+    # The ts of the first timestamped line, which is min_ts: the origin of --start_time windows (see MIN_TS_ORIGIN)
+    def find_first_ts(self):
+        with open_timeline(self.path, self.compression, self.checkpoints) as f:
+            for line in f:
+                ts = self.ts_extractor(line, verbose=False)
+                if ts is not None:
+                    return ts
+        raise RuntimeError(f'No timestamped events found in {self.path}')
+
+    def find_min_max_ts(self, tail_bytes=100 * 1000):
+        min_ts = self.find_first_ts()
+        with open(self.path, 'rb') as f:
+            f.seek(max(self.file_size_bytes - tail_bytes, 0))
+            if f.tell() > 0:
+                f.readline()
+            max_ts = min_ts
+            for line in f:
+                ts = self.ts_extractor(line, verbose=False)
+                if ts is not None:
+                    max_ts = max(ts, max_ts)
+        return min_ts, max_ts
+
+
+    # One sequential read that replaces summarize() + find_metadata_events() + build_index()
+    def scan(self, bytes_per_index, max_lines_to_scan_for_metadata, start_byte=0, step_pid=None, rollup=False,
+             index_steps=False, verbose=False):
+        if verbose:
+            self.print_file_size()
+            print("")
+            print(f'Counting lines, scanning first {humanize(max_lines_to_scan_for_metadata)} lines for metadata events '
+                  f'and building index ({humanize_bytes(bytes_per_index)} per index)')
+        time.sleep(0.1)
+
+        phase = self.profiler.start("scan")
+        start_ts = time.time()
+        with tqdm(total=self.file_size_bytes - start_byte) as pbar:
+            if self.workers > 1:
+                result = scan_byte_range_parallel(self.path, start_byte, self.file_size_bytes, bytes_per_index,
+                                                  max_metadata_lines=max_lines_to_scan_for_metadata,
+                                                  workers=self.workers, pbar=pbar, ts_extractor=self.ts_extractor,
+                                                  step_pid=step_pid, rollup=rollup, index_steps=index_steps)
+            else:
+                result = scan_byte_range(self.path, start_byte, self.file_size_bytes, bytes_per_index,
+                                         max_metadata_lines=max_lines_to_scan_for_metadata, pbar=pbar,
+                                         ts_extractor=self.ts_extractor, step_pid=step_pid, rollup=rollup,
+                                         index_steps=index_steps)
+        end_ts = time.time()
+        phase.stop(bytes_read=self.file_size_bytes - start_byte, lines=result["line_count"])
+        time.sleep(0.1)
+
+        if verbose:
+            print(f'Time taken (Fused scan, {self.workers} workers): {humanize_float(end_ts - start_ts)}s')
+        return result
+
+
+    # Compressed timelines cannot be probed at the tail before the scan, so the whole file is decompressed once with a
+    # fine index spacing and the index is thinned to secs_per_index afterwards. The scan also records the checkpoints
+    # that later reads start decompressing from.
+    def build_compressed(self, max_lines_to_scan_for_metadata, bytes_per_index=None, secs_per_index=1, verbose=False):
+        fine_bytes_per_index = bytes_per_index or 64 * 1024
+        if verbose:
+            print(f'Decompressing {humanize_bytes(self.disk_size_bytes)}')
+        time.sleep(0.1)
+
+        phase = self.profiler.start("compressed_scan")
+        start_ts = time.time()
+        with tqdm(total=self.disk_size_bytes) as pbar:
+            scan = scan_byte_range(self.path, 0, None, fine_bytes_per_index,
+                                   max_metadata_lines=max_lines_to_scan_for_metadata, pbar=pbar,
+                                   ts_extractor=self.ts_extractor, compression=self.compression, rollup=self.rollup,
+                                   index_steps=self.index_steps)
+        end_ts = time.time()
+        phase.stop(bytes_read=scan["end_byte"], lines=scan["line_count"])
+        time.sleep(0.1)
+
+        if scan["min_ts"] is None:
+            raise RuntimeError(f'No timestamped events found in {self.path}')
+        self.file_size_bytes = scan["end_byte"]
+        self.line_count = scan["line_count"]
+        self.min_ts = self.find_first_ts()
+        self.max_ts = scan["max_ts"]
+        self.duration_secs = (self.max_ts - self.min_ts) / MICROSECONDS_PER_SEC
+        self.metadata_events = scan["metadata_events"]
+        self.checkpoints = scan["checkpoints"]
+
+        if bytes_per_index is None:
+            if secs_per_index is None:
+                raise RuntimeError("One of bytes_per_index or secs_per_index must be not None")
+            jumps = self.duration_secs / secs_per_index
+            bytes_per_index = max(int(self.file_size_bytes / jumps), 1) if jumps > 0 else self.file_size_bytes
+
+        index = []
+        for ts, byte in scan["index"]:
+            if not index or byte >= index[-1][1] + bytes_per_index:
+                index.append((ts, byte))
+
+        self.index = TimestampIndex.from_entries(index, bytes_per_index=bytes_per_index, checkpoints=self.checkpoints)
+        self.index.save(self.index_path)
+        self.index = TimestampIndex.load(self.index_path)
+        self.save_step_index(scan["step_pid"], scan["steps"])
+        self.save_rollup(scan["rollup"])
+
+        if verbose:
+            print(f'{humanize_bytes(self.file_size_bytes)} decompressed, {humanize(len(self.checkpoints))} checkpoints')
+            print(f'Time taken (Compressed scan): {humanize_float(end_ts - start_ts)}s')
+
+    # Builds the activity rollup and/or the step index of a timeline whose metadata was built without them. Reads the
+    # whole timeline once more
+    def build_rollup_and_step_index(self, rollup=False, index_steps=False, verbose=False):
+        parts = [name for name, build in (("activity rollup", rollup), ("step index", index_steps)) if build]
+        print(f'Scanning file for the {" and ".join(parts)}')
+        bytes_per_index = self.index.bytes_per_index or SCAN_BLOCK_BYTES
+        if self.compression is not None:
+            phase = self.profiler.start("compressed_scan")
+            with tqdm(total=self.disk_size_bytes) as pbar:
+                scan = scan_byte_range(self.path, 0, None, bytes_per_index, max_metadata_lines=0, pbar=pbar,
+                                       ts_extractor=self.ts_extractor, compression=self.compression, rollup=rollup,
+                                       index_steps=index_steps)
+            phase.stop(bytes_read=scan["end_byte"], lines=scan["line_count"])
+        else:
+            scan = self.scan(bytes_per_index, 0, rollup=rollup, index_steps=index_steps, verbose=verbose)
+        if rollup:
+            self.save_rollup(scan["rollup"])
+        if index_steps:
+            self.save_step_index(scan["step_pid"], scan["steps"])
+            self.save_summary()
+
+    # A rollup that is not rebuilt with the rest of the metadata would be stale, so it is removed
+    def save_rollup(self, rollup):
+        if rollup is None:
+            if os.path.exists(self.rollup_path):
+                os.remove(self.rollup_path)
+            return
+        rollup.covered_bytes = self.file_size_bytes
+        rollup.save(self.rollup_path)
+
+    # Like the rollup, a step index that is not rebuilt with the rest of the metadata is removed
+    def save_step_index(self, step_pid, steps):
+        self.step_pid = step_pid
+        if steps is None:
+            self.step_index = None
+            if os.path.exists(self.step_index_path):
+                os.remove(self.step_index_path)
+            return
+        TimestampIndex.from_entries(steps).save(self.step_index_path)
+        self.step_index = TimestampIndex.load(self.step_index_path)
+
+    # Random access view of the timeline's (decompressed) bytes
+    def map(self):
+        return map_timeline(self.path, self.compression, self.checkpoints)
+
+
+    # Bring the summary and index up to date with a file that has grown since previous_file_size was recorded.
+    # Only bytes after previous_file_size are read. Lines are counted by newline so a line that was still being
+    # written at the last load is counted exactly once.
+    def append(self, previous_file_size, verbose=False):
+        phase = self.profiler.start("append")
+        bytes_per_index = self.index.bytes_per_index
+        if not bytes_per_index:
+            # Index converted from an old summary. Keep the spacing it was built with
+            if len(self.index) > 1:
+                bytes_per_index = (self.index[len(self.index) - 1][1] - self.index[0][1]) // (len(self.index) - 1)
+            bytes_per_index = max(bytes_per_index, SCAN_BLOCK_BYTES)
+
+        # An existing rollup is extended if it covers everything before the appended bytes
+        rollup = None
+        if os.path.exists(self.rollup_path):
+            rollup = ActivityRollup.load(self.rollup_path)
+            if rollup.covered_bytes != previous_file_size:
+                rollup = None
+
+        # Start at the line that was still being written at the last load, if any, so that line is read whole. The
+        # bytes between its start and previous_file_size hold no newline, so the line count is unchanged
+        start_byte = previous_file_size
+        with open(self.path, 'rb') as f:
+            while start_byte > 0:
+                chunk_start = max(start_byte - 64 * 1024, 0)
+                f.seek(chunk_start)
+                newline = f.read(start_byte - chunk_start).rfind(b'\n')
+                if newline != -1:
+                    start_byte = chunk_start + newline + 1
+                    break
+                start_byte = chunk_start
+
+        scan = self.scan(bytes_per_index, 0, start_byte=start_byte, step_pid=self.step_pid,
+                         rollup=rollup is not None, index_steps=self.step_index is not None, verbose=verbose)
+
+        self.line_count += scan["line_count"]
+        _, tail_max_ts = self.find_min_max_ts()
+        self.max_ts = max(self.max_ts, tail_max_ts, scan["max_ts"] or tail_max_ts)
+        self.duration_secs = (self.max_ts - self.min_ts) / MICROSECONDS_PER_SEC
+
+        last_indexed_byte = self.index[len(self.index) - 1][1] if len(self.index) > 0 else 0
+        new_entries = [(ts, byte) for ts, byte in scan["index"] if byte > last_indexed_byte]
+        self.index = TimestampIndex.from_entries(list(self.index) + new_entries, bytes_per_index=bytes_per_index)
+        self.index.save(self.index_path)
+        self.index = TimestampIndex.load(self.index_path)
+
+        # Without a step index from the first build, appended steps could not be numbered
+        if self.step_index is not None:
+            self.save_step_index(scan["step_pid"], list(self.step_index) + scan["steps"])
+        if rollup is not None:
+            rollup.merge(scan["rollup"])
+            self.save_rollup(rollup)
+
+        phase.stop()
+
+        if verbose:
+            print(f'{humanize(scan["line_count"])} new lines, {humanize(len(new_entries))} new indices')
+
+
     def build_index(self, jump_bytes, verbose=False):
 
         # JUMP_ARG = 65536 # Default
@@ -398,6 +2592,7 @@ class HorovodTimeline:
             print(f'Building timestamp index:')
         time.sleep(0.1)
 
+        phase = self.profiler.start("build_index")
         start_ts = time.time()
         with tqdm(total=self.file_size_bytes) as pbar:
             last = 0
@@ -414,6 +2609,7 @@ class HorovodTimeline:
                     last = ptr
 
         end_ts = time.time()
+        phase.stop(bytes_read=self.file_size_bytes)
         time.sleep(0.1)
 
         if verbose:
@@ -425,37 +2621,223 @@ class HorovodTimeline:
 
 
 
+    # Writes a small whole-run trace to <timeline>-overview.json in one streaming pass. Events shorter than
+    # min_event_secs (default: 1/1000 of the run, under a pixel when the whole run is on screen) are merged into
+    # aggregate spans per pid/tid and time bucket, whose args hold the merged event count and busy time per op. Buckets
+    # start at 1/OVERVIEW_BUCKETS of the run and are widened until the trace has at most max_events events.
+    def overview(self, min_event_secs=None, max_events=OVERVIEW_MAX_EVENTS, verbose=False):
+        span_us = max(self.max_ts - self.min_ts, 1)
+        bucket_us = max(span_us // OVERVIEW_BUCKETS, 1)
+        min_event_us = span_us / 1000. if min_event_secs is None else min_event_secs * MICROSECONDS_PER_SEC
+        print(f'Building overview of {humanize_bytes(self.file_size_bytes)}')
+        time.sleep(0.1)
+
+        phase = self.profiler.start("overview")
+        start_ts = time.time()
+        with tqdm(total=self.file_size_bytes) as pbar:
+            if self.workers > 1:
+                shards = map_byte_range_shards(collect_overview, self.path, 0, self.file_size_bytes, self.workers,
+                                               func_args=(self.min_ts, bucket_us, min_event_us), pbar=pbar)
+                overview = shards[0]
+                for other in shards[1:]:
+                    overview.merge(other)
+            else:
+                overview = collect_overview(self.path, 0, self.file_size_bytes, self.min_ts, bucket_us, min_event_us,
+                                            pbar=pbar, compression=self.compression, checkpoints=self.checkpoints)
+        overview.limit(max_events, span_us)
+        end_ts = time.time()
+        phase.stop(bytes_read=self.file_size_bytes, lines=self.line_count)
+        time.sleep(0.1)
+
+        overview_path = f'{self.base_path}-overview.json'
+        with open(overview_path, 'wb', buffering=EXTRACT_WRITE_BUFFER_BYTES) as o:
+            o.write(self.metadata_header().encode())
+            for event in overview.trace_events():
+                o.write(f',\n{json.dumps(event)}'.encode())
+            o.write(b"\n]")
+
+        print(f'{humanize(len(overview.spans))} spans of at least {humanize_float(min_event_us / 1000.)} ms and '
+              f'{humanize(len(overview.aggregates))} aggregates of {humanize_float(overview.bucket_us / 1000.)} ms '
+              f'buckets, {humanize_bytes(os.stat(overview_path).st_size)}')
+        if verbose:
+            print(f'Time taken (Overview): {humanize_float(end_ts - start_ts)}s')
+        return overview_path
+
+    # Builds (or extends to the current end of the timeline) the name/pid index used to skip buckets of bucket_bytes
+    # during extracts filtered by --names or --pids. An index with other buckets is rebuilt
+    def build_filter_index(self, bucket_bytes=FILTER_BUCKET_BYTES, verbose=False):
+        filter_index = self.load_filter_index()
+        if filter_index is None or filter_index.bucket_bytes != bucket_bytes:
+            filter_index = FilterIndex(bucket_bytes)
+        filter_index.decode_all()
+        start_byte = filter_index.covered_bytes
+        print(f'Indexing event names and pids in {humanize_bytes(self.file_size_bytes - start_byte)}')
+        time.sleep(0.1)
+
+        phase = self.profiler.start("filter_index")
+        start_ts = time.time()
+        with tqdm(total=self.file_size_bytes - start_byte) as pbar:
+            if self.workers > 1:
+                results = map_byte_range_shards(collect_filter_buckets, self.path, start_byte, self.file_size_bytes,
+                                                self.workers, func_args=(filter_index.bucket_bytes,), pbar=pbar)
+            else:
+                results = [collect_filter_buckets(self.path, start_byte, self.file_size_bytes,
+                                                  filter_index.bucket_bytes, pbar=pbar, compression=self.compression,
+                                                  checkpoints=self.checkpoints)]
+        end_ts = time.time()
+        phase.stop(bytes_read=self.file_size_bytes - start_byte)
+        time.sleep(0.1)
+
+        for result in results:
+            filter_index.add(result)
+        filter_index.covered_bytes = self.file_size_bytes
+        filter_index.save(self.filter_index_path)
+        self.filter_index = filter_index
+
+        print(f'{humanize(len(filter_index.names))} names and {humanize(len(filter_index.pids))} pids indexed in '
+              f'{humanize_bytes(filter_index.bucket_bytes)} buckets')
+        if verbose:
+            print(f'Time taken (Filter index): {humanize_float(end_ts - start_ts)}s')
+        return filter_index
+
+    # Streams the whole timeline and aggregates the duration of every operation. Writes the per (op, pid) breakdown
+    # to <timeline>.opstats.json and returns the OpStats
+    def op_stats(self, verbose=False):
+        print(f'Pairing B/E events over {humanize_bytes(self.file_size_bytes)}')
+        time.sleep(0.1)
+
+        phase = self.profiler.start("op_stats")
+        start_ts = time.time()
+        with tqdm(total=self.file_size_bytes) as pbar:
+            if self.workers > 1:
+                shard_stats = map_byte_range_shards(collect_op_stats, self.path, 0, self.file_size_bytes, self.workers,
+                                                    pbar=pbar)
+                stats = shard_stats[0]
+                for other in shard_stats[1:]:
+                    stats.merge(other)
+            else:
+                stats = collect_op_stats(self.path, 0, self.file_size_bytes, pbar=pbar, compression=self.compression,
+                                         checkpoints=self.checkpoints)
+        end_ts = time.time()
+        phase.stop(bytes_read=self.file_size_bytes, lines=self.line_count)
+        time.sleep(0.1)
+
+        pid_names = {e["pid"]: e["args"]["name"] for e in self.metadata_events
+                     if e.get("name") == "process_name" and "pid" in e and "name" in e.get("args", {})}
+        op_stats_path = self.base_path + ".opstats.json"
+        with open(op_stats_path, 'w+') as op_stats_file:
+            json.dump({
+                "ops": {name: histogram.to_dict() for name, histogram in stats.by_name.items()},
+                "ops_by_pid": [dict(op=name, pid=pid, pid_name=pid_names.get(pid), **histogram.to_dict())
+                               for (name, pid), histogram in sorted(stats.by_name_and_pid.items(), key=str)],
+            }, op_stats_file, indent=4)
+
+        if verbose:
+            print(f'Time taken (Op stats): {humanize_float(end_ts - start_ts)}s')
+        print(f'Per (op, pid) stats written to {op_stats_path}')
+        return stats
+
+    def print_op_stats(self, stats):
+        print(f'{humanize(stats.events)} events')
+        print("")
+        header = f'{"op":<32} {"count":>14} {"total (s)":>12} {"mean (ms)":>10} {"p50 (ms)":>10} {"p99 (ms)":>10}'
+        print(header)
+        print("-" * len(header))
+        for name, histogram in sorted(stats.by_name.items(), key=lambda item: -item[1].total):
+            print(f'{str(name):<32} {humanize(histogram.count):>14} '
+                  f'{humanize_float(histogram.total / MICROSECONDS_PER_SEC):>12} '
+                  f'{humanize_float(histogram.mean() / 1000.):>10} '
+                  f'{humanize_float(histogram.percentile(50) / 1000.):>10} '
+                  f'{humanize_float(histogram.percentile(99) / 1000.):>10}')
+
     def print_stats(self, verbose=False):
         self.print_file_size()
         self.print_timeline_duration()
         print(f'{humanize(self.line_count)} lines in timeline file')
+        if self.step_index is not None and len(self.step_index) > 1:
+            mean_step_secs = (self.step_index[len(self.step_index) - 1][0] - self.step_index[0][0]) / \
+                             (len(self.step_index) - 1) / MICROSECONDS_PER_SEC
+            print(f'{humanize(len(self.step_index))} training steps (step pid {self.step_pid}), '
+                  f'mean step time {humanize_float(mean_step_secs * 1000)}ms')
+            # A step pid that skips steps leaves long gaps, so the median gap implies more steps than were found
+            step_ts = [ts for ts, _ in self.step_index]
+            gaps = sorted(b - a for a, b in zip(step_ts, step_ts[1:]))
+            median_gap = gaps[len(gaps) // 2]
+            expected_steps = self.duration_secs * MICROSECONDS_PER_SEC / median_gap if median_gap > 0 else 0
+            if len(self.step_index) < expected_steps / 2:
+                print(f'WARNING: the median step time ({humanize_float(median_gap / 1000)}ms) implies about '
+                      f'{humanize(int(expected_steps))} steps. Pid {self.step_pid} may not negotiate every step')
         self.print_index_stats()
+        self.print_activity()
+
+    # Activity histogram and idle/stalled periods from the rollup sidecar, without reading the timeline. A second is
+    # idle if it has fewer than IDLE_FRACTION of the median events per second, and stalled if tensors were negotiating
+    # but nothing was communicated (typically ranks waiting for a rank that has not submitted the tensor)
+    def print_activity(self, rows=ACTIVITY_ROWS, max_periods=10):
+        if not os.path.exists(self.rollup_path):
+            return
+        rollup = ActivityRollup.load(self.rollup_path)
+        first_second, events, ranks, busy_us = rollup.columns()
+        if not events:
+            return
+        origin_second = int(self.min_ts // ActivityRollup.SECOND_US)
+        second_count = len(events)
+        categories = sorted(busy_us, key=lambda category: -sum(busy_us[category]))
+
+        median_events = sorted(events)[second_count // 2]
+        negotiate = busy_us.get("negotiate", [0] * second_count)
+        communicate = busy_us.get("communicate", [0] * second_count)
+        flags = {
+            "idle": [count < IDLE_FRACTION * median_events for count in events],
+            "stalled": [negotiate[i] > 0 and communicate[i] == 0 for i in range(second_count)],
+        }
 
+        print("")
+        if rollup.covered_bytes < self.file_size_bytes:
+            print(f'Activity rollup covers the first {humanize_bytes(rollup.covered_bytes)}. '
+                  f'Rebuild with --force_metadata_rebuild to include the rest')
+        secs_per_row = -(-second_count // rows)
+        row_events = [sum(events[i:i + secs_per_row]) / secs_per_row for i in range(0, second_count, secs_per_row)]
+        max_row_events = max(row_events) or 1
+        print(f'Activity ({humanize(secs_per_row)}s per row, busy time is the share of op time per category):')
+        for row, i in enumerate(range(0, second_count, secs_per_row)):
+            start = first_second + i - origin_second
+            end = start + min(secs_per_row, second_count - i)
+            bar = "#" * int(round(30 * row_events[row] / max_row_events))
+            total_busy = sum(sum(busy_us[category][i:i + secs_per_row]) for category in categories) or 1
+            busy = ", ".join(f'{category} {int(100 * sum(busy_us[category][i:i + secs_per_row]) / total_busy)}%'
+                             for category in categories[:3])
+            marks = " ".join(f'{name.upper()} {sum(flag[i:i + secs_per_row])}s' for name, flag in flags.items()
+                             if any(flag[i:i + secs_per_row]))
+            print(f'    {start:>7}s-{str(end) + "s":<8} {bar:<30} {humanize(int(row_events[row])):>10} events/s '
+                  f'{max(ranks[i:i + secs_per_row]):>4} ranks  {busy}  {marks}'.rstrip())
+
+        # Consecutive flagged seconds, longest first
+        for name, flag in flags.items():
+            periods = []
+            for i, flagged in enumerate(flag):
+                if not flagged:
+                    continue
+                if periods and periods[-1][1] == i:
+                    periods[-1][1] = i + 1
+                else:
+                    periods.append([i, i + 1])
+            if not periods:
+                continue
+            periods.sort(key=lambda period: period[0] - period[1])
+            print(f'{humanize(len(periods))} {name} periods, {humanize(sum(end - start for start, end in periods))}s '
+                  f'in total. Longest:')
+            for start, end in periods[:max_periods]:
+                print(f'    {first_second + start - origin_second}s to {first_second + end - origin_second}s '
+                      f'({end - start}s)')
 
 
-    def parse_line_as_json(self, line, verbose=True):
-        line = line.strip()
-        if line[-2:] == "},":
-            line = line[:-1]
 
-        if line == "]" or line == "[":
-            return None
-
-        try:
-            j = json.loads(line)
-            return j
-        except Exception as ex:
-            if verbose:
-                sys.stdout.write(str(ex))
-                sys.stdout.write(f'[json.loads | ERROR]: "{line}"\n')
-            return None
+    def parse_line_as_json(self, line, verbose=True):
+        return parse_line_as_json(line, verbose=verbose)
 
     def extract_ts_from_line(self, line, verbose=True):
-        j = self.parse_line_as_json(line, verbose=verbose)
-        if j is None:
-            return None
-        else:
-            return j['ts'] if 'ts' in j.keys() else None
+        return self.ts_extractor(line, verbose=verbose)
 
     def extract_ts_from_json(self, j):
         if j is None:
@@ -465,13 +2847,45 @@ class HorovodTimeline:
 
 
 
-    def extract_and_save_slice(self, start_secs, extract_duration_secs, return_slice=False, verbose=False):
-        extract_file_path = f'{self.base_path}-extract-{start_secs}s-to-{start_secs+extract_duration_secs}s.json'
-        if verbose:
-            print(f'Extract file: {extract_file_path}')
-
-        if return_slice:
-            event_list = []
+    def extract_file_path(self, start_secs, extract_duration_secs, output_format="json"):
+        return (f'{self.base_path}-extract-{start_secs}s-to-{start_secs+extract_duration_secs}s'
+                f'{TRACE_WRITERS[output_format].EXTENSION}')
+
+    def steps_file_path(self, start_step, num_steps, output_format="json"):
+        return f'{self.base_path}-steps-{start_step}-to-{start_step+num_steps}{TRACE_WRITERS[output_format].EXTENSION}'
+
+    # Returns (start_secs, duration_secs) of num_steps training steps from start_step (0 is the first step in the file).
+    # A step runs from its boundary in the step index to the next one; the last step ends at max_ts
+    def step_window(self, start_step, num_steps=1):
+        if self.step_index is None:
+            self.build_rollup_and_step_index(index_steps=True)
+        step_count = len(self.step_index)
+        if step_count == 0:
+            raise RuntimeError(f'No training steps (NEGOTIATE_ALLREDUCE events) found in {self.path}')
+        if start_step < 0 or start_step >= step_count or num_steps < 1:
+            raise RuntimeError(f'Steps {start_step} to {start_step+num_steps} are out of range. '
+                               f'{self.path} has {humanize(step_count)} steps')
+
+        start_ts = self.step_index[start_step][0]
+        end_step = start_step + num_steps
+        end_ts = self.step_index[end_step][0] - 1 if end_step < step_count else self.max_ts
+        return (start_ts - self.min_ts) / MICROSECONDS_PER_SEC, (end_ts - start_ts) / MICROSECONDS_PER_SEC
+
+    # Same as window_bounds() for num_steps training steps from start_step: the window of step_window() with the same 2s
+    # buffer for out-of-order events, so a step extract holds the same events as the equivalent time window. The byte
+    # range also covers the bytes from the first step's boundary line to the boundary after the last step
+    def step_bounds(self, start_step, num_steps=1):
+        start_secs, extract_duration_secs = self.step_window(start_step, num_steps)
+        min_extract_ts, max_extract_ts, min_buffer_byte, max_buffer_byte = self.window_bounds(start_secs,
+                                                                                              extract_duration_secs)
+        end_step = start_step + num_steps
+        start_byte = self.step_index[start_step][1]
+        end_byte = self.step_index[end_step][1] if end_step < len(self.step_index) else self.file_size_bytes
+        return min_extract_ts, max_extract_ts, min(min_buffer_byte, start_byte), max(max_buffer_byte, end_byte)
+
+    # Returns (min_extract_ts, max_extract_ts, min_buffer_byte, max_buffer_byte) for a window. Events are taken from
+    # the byte range covering the window plus a 2s buffer on each side, since ts are not strictly ordered in the file
+    def window_bounds(self, start_secs, extract_duration_secs):
         min_extract_ts = start_secs*MICROSECONDS_PER_SEC + self.min_ts
         min_buffer_ts = min_extract_ts - (2*MICROSECONDS_PER_SEC)
         if min_buffer_ts < 0:
@@ -482,77 +2896,453 @@ class HorovodTimeline:
         if max_buffer_ts > self.max_ts:
             max_buffer_ts = self.max_ts
 
-        min_buffer_byte = self.search_index(min_buffer_ts)[0]
-        max_buffer_byte = self.search_index(max_buffer_ts)[1]
+        min_buffer_byte = self.search_index(min_buffer_ts, refine=True)[0]
+        max_buffer_byte = self.search_index(max_buffer_ts, refine=True)[1]
+        return min_extract_ts, max_extract_ts, min_buffer_byte, max_buffer_byte
+
+    def metadata_header(self):
+        return "[" + ",".join(f'\n{json.dumps(metadata_event)}' for metadata_event in self.metadata_events)
+
+    # Lazily yields the events of a time range. With raw=True the raw bytes of each line (without the trailing comma)
+    # are yielded instead of decoded events. pids, tids and names restrict the output to events whose pid/tid/name is
+    # in the given collection; events without that key (e.g. "E" events have no name) are dropped by that filter.
+    # Lines are read from a memory map whose pages are released as the iterator moves on, so memory use does not grow
+    # with the size of the range.
+    def iter_events(self, start_secs, extract_duration_secs, pids=None, tids=None, names=None, raw=False, pbar=None):
+        min_extract_ts, max_extract_ts, min_buffer_byte, max_buffer_byte = self.window_bounds(start_secs,
+                                                                                              extract_duration_secs)
+        return self.iter_events_in_byte_range(min_buffer_byte, max_buffer_byte, min_extract_ts, max_extract_ts,
+                                              pids=pids, tids=tids, names=names, raw=raw, pbar=pbar)
+
+    # ranges, if given, are the line-aligned parts of [min_byte, max_byte) to read, as returned by
+    # filtered_byte_ranges(), so callers that already computed them do not compute them again
+    def iter_events_in_byte_range(self, min_byte, max_byte, min_ts, max_ts, pids=None, tids=None, names=None,
+                                  raw=False, pbar=None, ranges=None):
+        pbar_throttler = 10 * 1000
+        filters = [(key, set(values)) for key, values in (("pid", pids), ("tid", tids), ("name", names))
+                   if values is not None]
 
-        bytes_to_scan = max_buffer_byte - min_buffer_byte
+        mm = self.map()
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+        i = 0
+        bytes_read = 0
+        try:
+            last_pbar_byte = min_byte
+            if ranges is None:
+                ranges = self.filtered_byte_ranges(mm, min_byte, max_byte, pids=pids, names=names)
+            for range_start, range_end in ranges:
+                pos = range_start
+                for line in iter_raw_lines(mm, range_start, range_end):
+                    pos += len(line)
+                    bytes_read += len(line)
+                    i += 1
+                    if pbar is not None and i % pbar_throttler == 0:
+                        pbar.update(pos - last_pbar_byte)
+                        last_pbar_byte = pos
+
+                    ts = self.ts_extractor(line, verbose=False)
+                    if ts is None or ts < min_ts or ts > max_ts:
+                        continue
+
+                    if not filters:
+                        yield strip_raw_line(line) if raw else parse_line_as_json(line, verbose=False)
+                        continue
+
+                    j = parse_line_as_json(line, verbose=False)
+                    if j is None or not all(key in j and j[key] in values for key, values in filters):
+                        continue
+                    yield strip_raw_line(line) if raw else j
+
+            # Skipped buckets count as scanned
+            if pbar is not None:
+                pbar.update(max_byte - last_pbar_byte)
+        finally:
+            mm.close()
+            self.profiler.count(bytes_read=bytes_read, lines=i)
+
+    # Returns the filter index saved by build_filter_index(), or None if there is none. It is read on the first call
+    def load_filter_index(self):
+        if not self.filter_index_loaded:
+            self.filter_index_loaded = True
+            if os.path.exists(self.filter_index_path):
+                filter_index = FilterIndex.load(self.filter_index_path)
+                if filter_index.covered_bytes <= self.file_size_bytes:
+                    self.filter_index = filter_index
+        return self.filter_index
+
+    # The line-aligned parts of [min_byte, max_byte) that can hold events matching pids and names according to the
+    # filter index. Without a filter index (see build_filter_index) or filters this is the whole range
+    def filtered_byte_ranges(self, mm, min_byte, max_byte, pids=None, names=None):
+        if (pids is None and names is None) or self.load_filter_index() is None:
+            return [(min_byte, max_byte)]
+
+        ranges = []
+        for range_start, range_end in self.filter_index.byte_ranges(min_byte, max_byte, pids=pids, names=names):
+            # A line belongs to the bucket it starts in
+            if range_start > min_byte:
+                range_start = mm.find(b'\n', range_start - 1) + 1 or max_byte
+            if range_end < max_byte:
+                range_end = mm.find(b'\n', range_end - 1) + 1 or max_byte
+            range_end = min(range_end, max_byte)
+            if range_start >= range_end:
+                continue
+            if ranges and range_start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], range_end))
+            else:
+                ranges.append((range_start, range_end))
+        return ranges
+
+    # Writes the events of a window to a trace file. With passthrough=True lines are copied as raw bytes, otherwise each
+    # event is decoded and re-encoded. return_slice=True also returns the events as a list, which holds the whole
+    # slice in memory; use iter_events() for large slices. output_format is a key of TRACE_WRITERS; passthrough only
+    # applies to "json". bounds, as returned by window_bounds(), replaces the bounds of the window.
+    def extract_and_save_slice(self, start_secs, extract_duration_secs, return_slice=False, verbose=False,
+                               passthrough=False, pids=None, tids=None, names=None, extract_file_path=None,
+                               output_format="json", bounds=None):
+        extract_file_path = extract_file_path or self.extract_file_path(start_secs, extract_duration_secs,
+                                                                        output_format)
+        passthrough = passthrough and output_format == "json"
+        if verbose:
+            print(f'Extract file: {extract_file_path}')
 
-        pbar_throttler = 10
+        event_list = [] if return_slice else None
+        min_extract_ts, max_extract_ts, min_buffer_byte, max_buffer_byte = (
+            bounds or self.window_bounds(start_secs, extract_duration_secs))
+        bytes_to_scan = max_buffer_byte - min_buffer_byte
 
-        last_pbar_offset = 0
+        ranges = None
+        if pids is not None or names is not None:
+            mm = self.map()
+            ranges = self.filtered_byte_ranges(mm, min_buffer_byte, max_buffer_byte, pids=pids, names=names)
+            mm.close()
+        if ranges is not None and self.filter_index is not None:
+            bytes_to_read = sum(end - start for start, end in ranges)
+            print(f'Scanning {humanize_bytes(bytes_to_read)} of {humanize_bytes(bytes_to_scan)}, '
+                  f'the rest has no matching names or pids')
+        else:
+            print(f'Scanning {humanize_bytes(bytes_to_scan)}')
+        time.sleep(0.1)
 
-        i = 0
+        phase = self.profiler.start("extract")
+        if (self.workers > 1 and not return_slice and output_format == "json" and
+                bytes_to_scan >= PARALLEL_EXTRACT_MIN_BYTES):
+            with tqdm(total=bytes_to_scan) as pbar:
+                self.write_extract_parallel(extract_file_path, min_buffer_byte, max_buffer_byte, min_extract_ts,
+                                            max_extract_ts, passthrough=passthrough, pids=pids, tids=tids,
+                                            names=names, pbar=pbar, ranges=ranges)
+            phase.stop()
+            return extract_file_path, event_list
 
-        print(f'Scanning {humanize_bytes(bytes_to_scan)}')
-        time.sleep(0.1)
         with tqdm(total=bytes_to_scan) as pbar:
-            with open(extract_file_path, 'w+') as o:
-                o.write("[")
-                first_line = True
-                for metadata_event in self.metadata_events:
-                    if first_line:
-                        o.write(f'\n{json.dumps(metadata_event)}')
-                        first_line = False
-                    else:
-                        o.write(f',\n{json.dumps(metadata_event)}')
+            with open(extract_file_path, 'wb', buffering=EXTRACT_WRITE_BUFFER_BYTES) as o:
+                writer = TRACE_WRITERS[output_format](o, self.metadata_events)
+                for event in self.iter_events_in_byte_range(min_buffer_byte, max_buffer_byte, min_extract_ts,
+                                                            max_extract_ts, pids=pids, tids=tids, names=names,
+                                                            raw=passthrough, pbar=pbar, ranges=ranges):
+                    writer.write(event)
+                    if return_slice:
+                        event_list.append(json.loads(event) if passthrough else event)
+                writer.close()
+        phase.stop()
+
+        return extract_file_path, event_list
+
+    # Writes the events of [min_byte, max_byte) with min_ts <= ts <= max_ts to extract_file_path with self.workers
+    # processes. The range, or the parts of it the filter index keeps (ranges, see iter_events_in_byte_range), is cut
+    # into newline-aligned parts that workers filter into temporary files next to the output. The parts are then
+    # concatenated in file order
+    def write_extract_parallel(self, extract_file_path, min_byte, max_byte, min_ts, max_ts, passthrough=False, pids=None,
+                               tids=None, names=None, pbar=None, ranges=None):
+        filters = [(key, set(values)) for key, values in (("pid", pids), ("tid", tids), ("name", names))
+                   if values is not None]
+        if ranges is None:
+            mm = self.map()
+            ranges = self.filtered_byte_ranges(mm, min_byte, max_byte, pids=pids, names=names)
+            mm.close()
+        parts = []
+        for range_start, range_end in ranges:
+            part_count = -(-(range_end - range_start) // PARALLEL_EXTRACT_PART_BYTES)
+            parts.extend(split_byte_range(self.path, range_start, range_end, part_count))
+
+        part_paths = []
+        line_count = 0
+        try:
+            for _ in parts:
+                fd, part_path = tempfile.mkstemp(dir=os.path.dirname(extract_file_path),
+                                                 prefix=os.path.basename(extract_file_path) + ".", suffix=".part")
+                os.close(fd)
+                part_paths.append(part_path)
+            args = [(part_number, write_extract_part, self.path, part_start, part_end,
+                     (part_path, min_ts, max_ts, passthrough, filters, self.ts_extractor, self.compression,
+                      self.checkpoints))
+                    for part_number, ((part_start, part_end), part_path) in enumerate(zip(parts, part_paths))]
+
+            if args:
+                with multiprocessing.Pool(min(self.workers, len(args))) as pool:
+                    for part_number, (_, part_lines), counts in pool.imap_unordered(_run_shard, args):
+                        add_parse_counts(counts)
+                        line_count += part_lines
+                        if pbar is not None:
+                            pbar.update(parts[part_number][1] - parts[part_number][0])
+
+            with open(extract_file_path, 'wb') as o:
+                o.write(self.metadata_header().encode())
+                for part_path in part_paths:
+                    with open(part_path, 'rb') as part:
+                        shutil.copyfileobj(part, o, EXTRACT_WRITE_BUFFER_BYTES)
+                o.write(b"\n]")
+        finally:
+            for part_path in part_paths:
+                os.remove(part_path)
+
+        bytes_read = sum(part_end - part_start for part_start, part_end in parts)
+        if pbar is not None:
+            # Skipped buckets count as scanned
+            pbar.update(max_byte - min_byte - bytes_read)
+        self.profiler.count(bytes_read=bytes_read, lines=line_count)
+
+    # extract_and_save_slice() of num_steps training steps from start_step. Reads the bytes of step_bounds()
+    def extract_and_save_steps(self, start_step, num_steps=1, output_format="json", **kwargs):
+        start_secs, extract_duration_secs = self.step_window(start_step, num_steps)
+        return self.extract_and_save_slice(start_secs, extract_duration_secs,
+                                           extract_file_path=self.steps_file_path(start_step, num_steps, output_format),
+                                           output_format=output_format, bounds=self.step_bounds(start_step, num_steps),
+                                           **kwargs)
+
+
+    # Extract many (start_secs, duration_secs) windows in one pass. The byte ranges of all windows are sorted and merged
+    # so every byte is read once, and each line is written to every output whose window contains it.
+    def extract_and_save_windows(self, windows, passthrough=False, verbose=False):
+        pbar_throttler = 10 * 1000
 
+        extracts = []
+        for start_secs, extract_duration_secs in windows:
+            min_extract_ts, max_extract_ts, min_buffer_byte, max_buffer_byte = self.window_bounds(start_secs,
+                                                                                                  extract_duration_secs)
+            extracts.append({
+                "path": self.extract_file_path(start_secs, extract_duration_secs),
+                "min_extract_ts": min_extract_ts,
+                "max_extract_ts": max_extract_ts,
+                "min_buffer_byte": min_buffer_byte,
+                "max_buffer_byte": max_buffer_byte,
+            })
+        extracts.sort(key=lambda e: e["min_buffer_byte"])
+
+        # Merge overlapping byte ranges
+        merged_ranges = []
+        for e in extracts:
+            if merged_ranges and e["min_buffer_byte"] <= merged_ranges[-1][1]:
+                merged_ranges[-1][1] = max(merged_ranges[-1][1], e["max_buffer_byte"])
+            else:
+                merged_ranges.append([e["min_buffer_byte"], e["max_buffer_byte"]])
 
-                with open(self.path, 'r') as h:
-                    h.seek(min_buffer_byte)
-                    while True:
-                        i += 1
-                        if i % pbar_throttler == 0:
-                            current_pbar_offset = h.tell() - min_buffer_byte
-                            pbar.update(current_pbar_offset - last_pbar_offset)
-                            last_pbar_offset = current_pbar_offset
-                        line = h.readline()
-                        j = self.parse_line_as_json(line, verbose=False)
-                        ts = self.extract_ts_from_json(j)
+        bytes_to_scan = sum(end - start for start, end in merged_ranges)
+        bytes_requested = sum(e["max_buffer_byte"] - e["min_buffer_byte"] for e in extracts)
+        print(f'Scanning {humanize_bytes(bytes_to_scan)} for {len(extracts)} windows '
+              f'({humanize_bytes(bytes_requested)} if extracted separately)')
+        time.sleep(0.1)
 
-                        if ts is not None:
-                            if ts >= min_extract_ts and ts <= max_extract_ts:
-                                if return_slice:
-                                    event_list.append(j)
-                                o.write(f',\n{json.dumps(j)}')
+        metadata_header = self.metadata_header().encode()
+        for e in extracts:
+            if verbose:
+                print(f'Extract file: {e["path"]}')
+            e["file"] = open(e["path"], 'wb', buffering=1024 * 1024)
+            e["file"].write(metadata_header)
 
+        phase = self.profiler.start("extract_batch")
+        with tqdm(total=bytes_to_scan) as pbar:
+            mm = self.map()
+
+            # Extracts are sorted by start byte, so they become active in order. active only changes when a
+            # window starts or ends, which is tracked with next_change_byte
+            pending = 0
+            active = []
+            for range_start, range_end in merged_ranges:
+                i = 0
+                pos = range_start
+                last_pbar_byte = range_start
+                next_change_byte = range_start
+                for line in iter_raw_lines(mm, range_start, range_end):
+                    if pos >= next_change_byte:
+                        while pending < len(extracts) and extracts[pending]["min_buffer_byte"] <= pos:
+                            active.append(extracts[pending])
+                            pending += 1
+                        active = [e for e in active if e["max_buffer_byte"] > pos]
+                        next_change_byte = min(e["max_buffer_byte"] for e in active) if active else range_end
+                        if pending < len(extracts):
+                            next_change_byte = min(next_change_byte, extracts[pending]["min_buffer_byte"])
+                    pos += len(line)
+
+                    i += 1
+                    if i % pbar_throttler == 0:
+                        pbar.update(pos - last_pbar_byte)
+                        last_pbar_byte = pos
+
+                    ts = self.ts_extractor(line, verbose=False)
+                    if ts is None:
+                        continue
+
+                    out_line = None
+                    for e in active:
+                        if e["min_extract_ts"] <= ts <= e["max_extract_ts"]:
+                            if out_line is None:
+                                if passthrough:
+                                    out_line = b',\n' + strip_raw_line(line)
+                                else:
+                                    j = parse_line_as_json(line, verbose=False)
+                                    out_line = f',\n{json.dumps(j)}'.encode()
+                            e["file"].write(out_line)
+
+                pbar.update(pos - last_pbar_byte)
+            mm.close()
+
+        for e in extracts:
+            e["file"].write(b"\n]")
+            e["file"].close()
+        phase.stop(bytes_read=bytes_to_scan)
+
+        return [e["path"] for e in extracts]
+
+
+
+    # Cuts the whole timeline into consecutive [min_ts, max_ts) windows whose bytes, plus header_bytes, fit in
+    # max_chunk_bytes. Cuts are placed at index entries, so a window is only larger than the cap when the events between
+    # two index entries are. Returns a list of (min_ts, max_ts)
+    def split_windows(self, max_chunk_bytes, header_bytes=0):
+        budget = max_chunk_bytes - header_bytes
+        if budget <= 0:
+            raise RuntimeError(f'Chunk size {humanize_bytes(max_chunk_bytes)} is smaller than the metadata '
+                               f'header ({humanize_bytes(header_bytes)})')
+
+        windows = []
+        cut_ts, cut_byte = self.min_ts, 0
+        previous = None
+        # The end of the file is the last cut point, so the tail is split like every other span
+        for ts, byte in itertools.chain(self.index, [(self.max_ts + 1, self.file_size_bytes)]):
+            if ts <= cut_ts:
+                continue
+            if previous is not None and byte - cut_byte > budget:
+                windows.append((cut_ts, previous[0]))
+                cut_ts, cut_byte = previous
+            previous = (ts, byte)
+        windows.append((cut_ts, self.max_ts + 1))
+        return windows
+
+    def split_file_path(self, chunk_number, min_ts, max_ts):
+        start_secs = round((min_ts - self.min_ts) / MICROSECONDS_PER_SEC, 3)
+        end_secs = round((min(max_ts, self.max_ts) - self.min_ts) / MICROSECONDS_PER_SEC, 3)
+        return f'{self.base_path}-split-{chunk_number:04d}-{start_secs}s-to-{end_secs}s.json'
+
+    # Writes the whole timeline as consecutive chunks of at most max_chunk_bytes (estimated from the index), each
+    # starting with the metadata events, so every chunk loads on its own in chrome://tracing or Perfetto. Each event
+    # lands in exactly one chunk. Chunks are written by self.workers processes
+    def split(self, max_chunk_bytes, passthrough=False, verbose=False):
+        header = self.metadata_header().encode()
+        windows = self.split_windows(max_chunk_bytes, header_bytes=len(header) + 2)
+
+        chunks = []
+        for chunk_number, (min_ts, max_ts) in enumerate(windows):
+            min_buffer_byte = self.search_index(max(min_ts - 2 * MICROSECONDS_PER_SEC, 0))[0]
+            max_buffer_byte = self.search_index(max_ts + 2 * MICROSECONDS_PER_SEC)[1]
+            chunks.append((chunk_number, write_split_chunk, self.path, min_buffer_byte, max_buffer_byte,
+                           (self.split_file_path(chunk_number, min_ts, max_ts), header, min_ts, max_ts, passthrough,
+                            self.ts_extractor, self.compression, self.checkpoints)))
+
+        bytes_to_scan = sum(chunk[4] - chunk[3] for chunk in chunks)
+        print(f'Writing {len(chunks)} chunks of at most {humanize_bytes(max_chunk_bytes)} '
+              f'(scanning {humanize_bytes(bytes_to_scan)})')
+        time.sleep(0.1)
 
-                        if h.tell() >= max_buffer_byte:
-                            o.write("\n]")
-                            if return_slice:
-                                return extract_file_path, event_list
-                            return extract_file_path, None
+        phase = self.profiler.start("split")
+        start_ts = time.time()
+        event_counts = [None] * len(chunks)
+        with tqdm(total=bytes_to_scan) as pbar:
+            if self.workers > 1:
+                with multiprocessing.Pool(min(self.workers, len(chunks))) as pool:
+                    for chunk_number, event_count, counts in pool.imap_unordered(_run_shard, chunks):
+                        event_counts[chunk_number] = event_count
+                        add_parse_counts(counts)
+                        pbar.update(chunks[chunk_number][4] - chunks[chunk_number][3])
+            else:
+                for chunk in chunks:
+                    chunk_number, event_count, _ = _run_shard(chunk)
+                    event_counts[chunk_number] = event_count
+                    pbar.update(chunk[4] - chunk[3])
+        end_ts = time.time()
+        phase.stop(bytes_read=bytes_to_scan)
+        time.sleep(0.1)
 
+        paths = [chunk[5][0] for chunk in chunks]
+        if verbose:
+            for path, event_count in zip(paths, event_counts):
+                print(f'{path}: {humanize(event_count)} events, {humanize_bytes(os.stat(path).st_size)}')
+            print(f'Time taken (Split): {humanize_float(end_ts - start_ts)}s')
+        return paths
 
 
-    # Returns (byte_index_before, byte_index_after)
-    def search_index(self, find_ts):
+    # Returns (byte_before, byte_after) around find_ts from the index and the refined entries, whichever is tighter.
+    # With refine=True a large bucket is refined first
+    def search_index(self, find_ts, refine=False):
         if find_ts <= self.min_ts:
             return (0, 0)
 
         if find_ts >= self.max_ts:
             return (self.file_size_bytes, self.file_size_bytes)
 
-        last_ts = 0
-        last_byte_index = 0
-        for ts, byte_ind in self.index:
-            # print(f'{humanize(ts)}    |   {humanize(byte_ind)}')
-            if find_ts >= last_ts and find_ts <= ts:
-                return (last_byte_index, byte_ind)
-
-            last_ts = ts
-            last_byte_index = byte_ind
+        if refine:
+            self.refine_index(find_ts)
+
+        byte_before, byte_after = self.index.search(find_ts, self.file_size_bytes)
+        refined_index = self.refined_index
+        if refined_index is not None:
+            refined_before, refined_after = refined_index.search(find_ts, self.file_size_bytes)
+            byte_before = max(byte_before, refined_before)
+            byte_after = min(byte_after, refined_after)
+        return byte_before, byte_after
+
+    # Splits the index bucket around find_ts into REFINE_SAMPLES parts by reading the ts of the first full line after
+    # evenly spaced offsets (recording the byte after that line, like build_index()), and repeats on the part holding
+    # find_ts until it is at most REFINE_MIN_BYTES. New entries are saved to <timeline>.refine.idx, so only the first
+    # extract around a ts pays for the samples. Compressed timelines are not refined since every sample would
+    # decompress from a checkpoint.
+    def refine_index(self, find_ts):
+        if self.compression is not None:
+            return
+        byte_before, byte_after = self.search_index(find_ts)
+        if byte_after - byte_before <= REFINE_MIN_BYTES:
+            return
+
+        with self.refine_lock:
+            phase = self.profiler.start("refine_index")
+            entries = {byte: ts for ts, byte in self.refined_index} if self.refined_index is not None else {}
+            entry_count = len(entries)
+            samples = 0
+            with open(self.path, 'rb') as f:
+                while True:
+                    byte_before, byte_after = self.search_index(find_ts)
+                    if byte_after - byte_before <= REFINE_MIN_BYTES:
+                        break
+                    sample_bytes = (byte_after - byte_before) // REFINE_SAMPLES
+                    new_entries = 0
+                    for i in range(1, REFINE_SAMPLES):
+                        f.seek(byte_before + i * sample_bytes - 1)
+                        f.readline()
+                        line = f.readline()
+                        samples += 1
+                        ts = self.ts_extractor(line, verbose=False) if line.endswith(b'\n') else None
+                        if ts is not None and byte_before < f.tell() < byte_after and f.tell() not in entries:
+                            entries[f.tell()] = ts
+                            new_entries += 1
+                    if new_entries == 0:
+                        # Lines longer than the parts, nothing left to split
+                        break
+                    self.refined_index = TimestampIndex.from_entries(
+                        [(ts, byte) for byte, ts in sorted(entries.items())])
 
-        raise RuntimeError("Something went very wrong while scanning index")
+            if len(entries) > entry_count:
+                self.refined_index.save(self.refined_index_path)
+                self.refined_index = TimestampIndex.load(self.refined_index_path)
+            phase.stop(lines=samples)
 
 
     def confirm_index_is_valid(self):
@@ -594,16 +3384,625 @@ class HorovodTimeline:
 
 
 
+# Columnar copy of a timeline for fast repeated queries. Built once from a full pass over the timeline and stored in
+# <timeline>.columns/ as one flat binary file per column plus meta.json:
+#   ts, dur, pid, tid, offset (int64), length, name (int32), ph (uint8)
+# name is dictionary encoded (meta.json holds the names), missing pid/tid/name are -1, missing dur is 0 and ph is the
+# ascii code of the phase. offset/length locate the raw line in the timeline so extracts copy the original bytes.
+# Rows are in file order and only include events that have a ts.
+#
+# Building only needs the standard library. Querying memory maps the columns with numpy and runs vectorized filters.
+class ColumnarTimeline:
+    COLUMNS = {"ts": 'q', "dur": 'q', "pid": 'q', "tid": 'q', "offset": 'q', "length": 'i', "name": 'i', "ph": 'B'}
+    NUMPY_DTYPES = {'q': "int64", 'i': "int32", 'B': "uint8"}
+    ROWS_PER_FLUSH = 1000 * 1000
+
+    def __init__(self, timeline):
+        if np is None:
+            raise RuntimeError("numpy is required to query a columnar timeline")
+
+        self.timeline = timeline
+        self.columns_path = self.columns_path_for(timeline)
+        meta_path = os.path.join(self.columns_path, "meta.json")
+        if not os.path.exists(meta_path):
+            raise RuntimeError(f'No columnar dataset at {self.columns_path}. Build it with --to_columnar')
+
+        stale_reason = self.stale_reason(timeline)
+        if stale_reason is not None:
+            raise RuntimeError(f'{stale_reason}. Rebuild it with --to_columnar')
+
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+
+        self.row_count = meta["row_count"]
+        self.names = meta["names"]
+        self.name_codes = {name: code for code, name in enumerate(self.names)}
+        for column, typecode in self.COLUMNS.items():
+            dtype = self.NUMPY_DTYPES[typecode]
+            if self.row_count == 0:
+                setattr(self, column, np.empty(0, dtype=dtype))
+            else:
+                setattr(self, column, np.memmap(os.path.join(self.columns_path, column + ".bin"), dtype=dtype,
+                                                mode='r', shape=(self.row_count,)))
+
+    @staticmethod
+    def columns_path_for(timeline):
+        return timeline.base_path + ".columns"
+
+    # Returns why the columnar dataset of timeline does not match it (the timeline grew or was replaced since the
+    # conversion), or None if it matches or there is no dataset
+    @classmethod
+    def stale_reason(cls, timeline):
+        columns_path = cls.columns_path_for(timeline)
+        meta_path = os.path.join(columns_path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+        if meta["file_size"] != timeline.file_size_bytes:
+            return (f'Columnar dataset at {columns_path} covers {humanize_bytes(meta["file_size"])} of a '
+                    f'{humanize_bytes(timeline.file_size_bytes)} timeline')
+        fingerprint = meta.get("fingerprint")
+        if fingerprint is None or tuple(fingerprint) != timeline_fingerprint(timeline.path, timeline.disk_size_bytes):
+            return f'Columnar dataset at {columns_path} does not match the timeline'
+        return None
+
+    @classmethod
+    def build(cls, timeline, verbose=False):
+        pbar_throttler = 10 * 1000
+        columns_path = cls.columns_path_for(timeline)
+        os.makedirs(columns_path, exist_ok=True)
+        meta_path = os.path.join(columns_path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
 
+        print(f'Converting {humanize_bytes(timeline.file_size_bytes)} to columns in {columns_path}')
+        time.sleep(0.1)
 
+        start_ts = time.time()
+        buffers = {column: array(typecode) for column, typecode in cls.COLUMNS.items()}
+        files = {column: open(os.path.join(columns_path, column + ".bin"), 'wb') for column in cls.COLUMNS}
+        name_codes = {}
+        row_count = 0
+
+        def flush():
+            for column, buffer in buffers.items():
+                buffer.tofile(files[column])
+                del buffer[:]
+
+        with tqdm(total=timeline.file_size_bytes) as pbar:
+            mm = timeline.map()
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+            i = 0
+            pos = 0
+            last_pbar_byte = 0
+            for line in iter_raw_lines(mm, 0, timeline.file_size_bytes):
+                offset = pos
+                pos += len(line)
+                i += 1
+                if i % pbar_throttler == 0:
+                    pbar.update(pos - last_pbar_byte)
+                    last_pbar_byte = pos
+
+                j = parse_line_as_json(line, verbose=False)
+                if j is None or 'ts' not in j:
+                    continue
+
+                name = j.get('name')
+                if name is None:
+                    name_code = -1
+                else:
+                    name_code = name_codes.get(name)
+                    if name_code is None:
+                        name_code = name_codes[name] = len(name_codes)
+
+                buffers["ts"].append(int(j['ts']))
+                buffers["dur"].append(int(j.get('dur', 0)))
+                buffers["pid"].append(int(j.get('pid', -1)))
+                buffers["tid"].append(int(j.get('tid', -1)))
+                buffers["offset"].append(offset)
+                buffers["length"].append(len(strip_raw_line(line)))
+                buffers["name"].append(name_code)
+                buffers["ph"].append(ord(j.get('ph', '\0')[0]))
+                row_count += 1
+
+                if len(buffers["ts"]) >= cls.ROWS_PER_FLUSH:
+                    flush()
+
+            pbar.update(pos - last_pbar_byte)
+            mm.close()
+
+        flush()
+        for f in files.values():
+            f.close()
+
+        # meta.json is written last so a partial conversion is never loaded
+        with open(meta_path, 'w+') as meta_file:
+            json.dump({
+                "row_count": row_count,
+                "names": sorted(name_codes, key=name_codes.get),
+                "file_size": timeline.file_size_bytes,
+                "fingerprint": timeline_fingerprint(timeline.path, timeline.disk_size_bytes),
+                "columns": {column: cls.NUMPY_DTYPES[typecode] for column, typecode in cls.COLUMNS.items()},
+            }, meta_file, indent=4)
+        end_ts = time.time()
 
+        if verbose:
+            print(f'Time taken (Columnar conversion): {humanize_float(end_ts - start_ts)}s')
+        print(f'{humanize(row_count)} events, {humanize(len(name_codes))} distinct names')
+
+    # Row numbers of the events in a window, with the same semantics as HorovodTimeline.iter_events()
+    def rows_in_window(self, start_secs, extract_duration_secs, pids=None, tids=None, names=None):
+        min_extract_ts, max_extract_ts, min_buffer_byte, max_buffer_byte = self.timeline.window_bounds(
+            start_secs, extract_duration_secs)
+        lo = int(np.searchsorted(self.offset, min_buffer_byte, side='left'))
+        hi = int(np.searchsorted(self.offset, max_buffer_byte, side='left'))
+
+        ts = self.ts[lo:hi]
+        mask = (ts >= min_extract_ts) & (ts <= max_extract_ts)
+        if pids is not None:
+            mask &= np.isin(self.pid[lo:hi], list(pids))
+        if tids is not None:
+            mask &= np.isin(self.tid[lo:hi], list(tids))
+        if names is not None:
+            mask &= np.isin(self.name[lo:hi], [self.name_codes[name] for name in names if name in self.name_codes])
+        return lo + np.flatnonzero(mask)
+
+    def extract_and_save_slice(self, start_secs, extract_duration_secs, pids=None, tids=None, names=None):
+        extract_file_path = self.timeline.extract_file_path(start_secs, extract_duration_secs)
+        rows = self.rows_in_window(start_secs, extract_duration_secs, pids=pids, tids=tids, names=names)
+        print(f'Copying {humanize(len(rows))} events')
+
+        mm = self.timeline.map()
+        with open(extract_file_path, 'wb', buffering=EXTRACT_WRITE_BUFFER_BYTES) as o:
+            o.write(self.timeline.metadata_header().encode())
+            for offset, length in zip(self.offset[rows].tolist(), self.length[rows].tolist()):
+                o.write(b',\n')
+                o.write(mm[offset:offset + length])
+            o.write(b"\n]")
+        mm.close()
+        return extract_file_path, None
+
+    def event_counts(self):
+        counts = {}
+        for start in range(0, self.row_count, self.ROWS_PER_FLUSH * 10):
+            chunk = self.name[start:start + self.ROWS_PER_FLUSH * 10]
+            for code, count in enumerate(np.bincount(chunk[chunk >= 0], minlength=len(self.names)).tolist()):
+                if count:
+                    counts[self.names[code]] = counts.get(self.names[code], 0) + count
+        return counts
+
+    # Vectorized version of HorovodTimeline.op_stats(). Rows are processed in chunks. Within a chunk, B/E events are
+    # grouped by (pid, tid) and by nesting depth; at a given depth the events of a group alternate B, E, B, E so each
+    # B pairs with the E right after it. B events left open at the end of a chunk are carried into the next chunk.
+    def op_stats(self, rows_per_chunk=50 * 1000 * 1000):
+        stats = OpStats()
+        begin, end = ord('B'), ord('E')
+        carried = np.empty(0, dtype="int64")
+
+        with tqdm(total=self.row_count) as pbar:
+            for start in range(0, self.row_count, rows_per_chunk):
+                stop = min(start + rows_per_chunk, self.row_count)
+                pbar.update(stop - start)
+
+                ph = self.ph[start:stop]
+                stats.events += stop - start
+                for (name_code, pid), durs in self.group_by_name_and_pid(
+                        np.flatnonzero(ph == ord('X')) + start, self.dur).items():
+                    # Rank ready markers, see OpStats
+                    name = self.names[name_code] if name_code >= 0 else None
+                    if isinstance(name, str) and name.isdigit():
+                        durs = durs[durs != 0]
+                        if len(durs) == 0:
+                            continue
+                    self.record_durations(stats, name_code, pid, durs)
+
+                rows = np.concatenate([carried, np.flatnonzero((ph == begin) | (ph == end)) + start])
+                if len(rows) == 0:
+                    continue
+                is_begin = self.ph[rows] == begin
+
+                _, group = np.unique(np.stack([self.pid[rows], self.tid[rows]], axis=1), axis=0, return_inverse=True)
+                group = group.reshape(-1)
+
+                # Positions in rows sorted by group. Within a group they stay in file order
+                order = np.argsort(group, kind='stable')
+                group_sorted = group[order]
+                begin_sorted = is_begin[order]
+                depth = np.cumsum(np.where(begin_sorted, 1, -1))
+                group_start = np.flatnonzero(np.r_[True, group_sorted[1:] != group_sorted[:-1]])
+                group_sizes = np.diff(np.r_[group_start, len(order)])
+                depth -= np.repeat(np.r_[0, depth][group_start], group_sizes)
+                # B events are at the depth they open, E events at the depth they close
+                level_sorted = np.where(begin_sorted, depth, depth + 1)
+
+                by_level = np.lexsort((np.arange(len(order)), level_sorted, group_sorted))
+                group_by_level = group_sorted[by_level]
+                level_by_level = level_sorted[by_level]
+                begin_by_level = begin_sorted[by_level]
+                same_key_as_next = ((group_by_level[1:] == group_by_level[:-1]) &
+                                    (level_by_level[1:] == level_by_level[:-1]))
+                pairs = np.flatnonzero(begin_by_level[:-1] & ~begin_by_level[1:] & same_key_as_next)
+                begin_positions = order[by_level[pairs]]
+                end_positions = order[by_level[pairs + 1]]
+
+                begin_rows = rows[begin_positions]
+                durs = self.ts[rows[end_positions]] - self.ts[begin_rows]
+                for (name_code, pid), group_durs in self.group_by_name_and_pid(begin_rows, durs, indexed=False).items():
+                    self.record_durations(stats, name_code, pid, group_durs)
+
+                paired = np.zeros(len(rows), dtype=bool)
+                paired[begin_positions] = True
+                paired[end_positions] = True
+                carried = rows[is_begin & ~paired]
+
+        return stats
+
+    # {(name_code, pid): array of values}. With indexed=True values are values[rows], otherwise values lines up with rows
+    def group_by_name_and_pid(self, rows, values, indexed=True):
+        if len(rows) == 0:
+            return {}
+        values = values[rows] if indexed else values
+        keys, inverse = np.unique(np.stack([self.name[rows].astype("int64"), self.pid[rows]], axis=1), axis=0,
+                                  return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind='stable')
+        splits = np.flatnonzero(np.diff(inverse[order])) + 1
+        return {(int(name_code), int(pid)): group_values
+                for (name_code, pid), group_values in zip(keys.tolist(), np.split(values[order], splits))}
+
+    def record_durations(self, stats, name_code, pid, durs):
+        name = self.names[name_code] if name_code >= 0 else None
+        buckets = np.where(durs > 0, np.floor(np.log2(np.maximum(durs, 1)) * DurationHistogram.BUCKETS_PER_DOUBLING)
+                           .astype("int64") + 1, 0)
+        bucket_ids, bucket_counts = np.unique(buckets, return_counts=True)
+
+        histogram = DurationHistogram()
+        histogram.count = len(durs)
+        histogram.total = int(durs.sum())
+        histogram.min = int(durs.min())
+        histogram.max = int(durs.max())
+        histogram.buckets = dict(zip(bucket_ids.tolist(), bucket_counts.tolist()))
+
+        stats.by_name.setdefault(name, DurationHistogram()).merge(histogram)
+        stats.by_name_and_pid.setdefault((name, pid), DurationHistogram()).merge(histogram)
+
+
+
+
+
+
+
+
+# Yields the events (or raw lines with raw=True) of stream with their pid replaced by remap[pid]
+def remap_pids(stream, remap, raw=False):
+    for event in stream:
+        if raw:
+            match = PID_PATTERN.search(event)
+            if match is not None and int(match.group(1)) in remap:
+                event = event[:match.start(1)] + str(remap[int(match.group(1))]).encode() + event[match.end(1):]
+        elif event.get('pid') in remap:
+            event['pid'] = remap[event['pid']]
+        yield event
+
+
+# Several timeline files (e.g. one per restart, or per node) presented as one timeline. Every file keeps its own
+# summary and index sidecars. Times are relative to the earliest event of all files. Extracts read the window of each
+# file with its own index and k-way merge the event streams by ts, so nothing is loaded whole or concatenated.
+# Within a file lines keep their file order (ts are not strictly ordered in Horovod timelines); across files the earliest
+# pending event is emitted first.
+#
+# The pid a tensor gets differs between ranks and restarts, so pids are remapped per file: pids with the same
+# process_name (tensor name) in any file share one pid, and a pid keeps its number unless a different tensor has it
+# already, in which case it gets a new one. Pids without a process_name are matched by number. Metadata events are
+# written once per (name, pid, tid) after remapping, from the first file that has them.
+class MergedTimeline:
+
+    def __init__(self, relpaths, **kwargs):
+        if len(relpaths) < 2:
+            raise RuntimeError("MergedTimeline needs at least two timelines")
+        self.timelines = []
+        for relpath in relpaths:
+            self.timelines.append(HorovodTimeline(relpath, **kwargs))
+            print("")
+        self.paths = [timeline.path for timeline in self.timelines]
+        self.ts_extractor = self.timelines[0].ts_extractor
+        self.compression = None
+        self.workers = self.timelines[0].workers
+
+        self.min_ts = min(timeline.min_ts for timeline in self.timelines)
+        self.max_ts = max(timeline.max_ts for timeline in self.timelines)
+        self.duration_secs = (self.max_ts - self.min_ts) / MICROSECONDS_PER_SEC
+        self.line_count = sum(timeline.line_count for timeline in self.timelines)
+        self.file_size_bytes = sum(timeline.file_size_bytes for timeline in self.timelines)
+        self.disk_size_bytes = sum(timeline.disk_size_bytes for timeline in self.timelines)
+
+        # pid in each file -> pid in the merged timeline. Pids of events without metadata are not remapped
+        self.pid_maps = []
+        merged_pids = {}
+        used_pids = set()
+        file_pids = [sorted({e["pid"] for e in timeline.metadata_events if "pid" in e}, key=str)
+                     for timeline in self.timelines]
+        next_pid = max([pid for pids in file_pids for pid in pids if isinstance(pid, int)] + [-1]) + 1
+        for timeline, pids in zip(self.timelines, file_pids):
+            names = {e["pid"]: e["args"]["name"] for e in timeline.metadata_events
+                     if e.get("name") == "process_name" and "pid" in e and "name" in e.get("args", {})}
+            pid_map = {}
+            for pid in pids:
+                key = ("name", names[pid]) if pid in names else ("pid", pid)
+                if key not in merged_pids:
+                    if pid in used_pids:
+                        merged_pids[key] = next_pid
+                        next_pid += 1
+                    else:
+                        merged_pids[key] = pid
+                    used_pids.add(merged_pids[key])
+                pid_map[pid] = merged_pids[key]
+            self.pid_maps.append(pid_map)
+
+        self.metadata_events = []
+        seen = set()
+        for timeline, pid_map in zip(self.timelines, self.pid_maps):
+            for metadata_event in timeline.metadata_events:
+                if "pid" in metadata_event:
+                    metadata_event = dict(metadata_event, pid=pid_map[metadata_event["pid"]])
+                key = (metadata_event.get("name"), str(metadata_event.get("pid")), str(metadata_event.get("tid")))
+                if key not in seen:
+                    seen.add(key)
+                    self.metadata_events.append(metadata_event)
 
+    def print_stats(self, verbose=False):
+        print(f'{len(self.timelines)} timelines:')
+        for timeline in self.timelines:
+            print(f'    {timeline.path}: {humanize_bytes(timeline.file_size_bytes)}, '
+                  f'{humanize_float(timeline.duration_secs)}s starting at '
+                  f'{humanize_float((timeline.min_ts - self.min_ts) / MICROSECONDS_PER_SEC)}s, '
+                  f'{humanize(timeline.line_count)} lines')
+        print("")
+        print(f'File size: {humanize_bytes(self.file_size_bytes)}')
+        print(f'Timeline Duration: {humanize_float(self.duration_secs)} seconds')
+        print(f'{humanize(self.line_count)} lines in timeline files')
+        remapped = sum(1 for pid_map in self.pid_maps for pid, merged_pid in pid_map.items() if pid != merged_pid)
+        if remapped:
+            print(f'{humanize(remapped)} pids remapped so each tensor keeps one pid across files')
+
+    def extract_file_path(self, start_secs, extract_duration_secs, output_format="json"):
+        return (f'{self.timelines[0].base_path}-merged-{len(self.timelines)}-extract-{start_secs}s-to-'
+                f'{start_secs+extract_duration_secs}s{TRACE_WRITERS[output_format].EXTENSION}')
+
+    def metadata_header(self):
+        return "[" + ",".join(f'\n{json.dumps(metadata_event)}' for metadata_event in self.metadata_events)
+
+    # Returns [(timeline, min_buffer_byte, max_buffer_byte)] for the files that overlap the window, and the window as
+    # (min_extract_ts, max_extract_ts)
+    def window_byte_ranges(self, start_secs, extract_duration_secs):
+        min_extract_ts = start_secs * MICROSECONDS_PER_SEC + self.min_ts
+        max_extract_ts = (start_secs + extract_duration_secs) * MICROSECONDS_PER_SEC + self.min_ts
+        ranges = []
+        for timeline in self.timelines:
+            if timeline.max_ts < min_extract_ts or timeline.min_ts > max_extract_ts:
+                continue
+            min_buffer_byte = timeline.search_index(max(min_extract_ts - 2 * MICROSECONDS_PER_SEC, 0), refine=True)[0]
+            max_buffer_byte = timeline.search_index(min(max_extract_ts + 2 * MICROSECONDS_PER_SEC, timeline.max_ts),
+                                                    refine=True)[1]
+            ranges.append((timeline, min_buffer_byte, max_buffer_byte))
+        return ranges, (min_extract_ts, max_extract_ts)
+
+    # Same as HorovodTimeline.iter_events(), merged over all files by ts. pids are pids of the merged timeline
+    def iter_events(self, start_secs, extract_duration_secs, pids=None, tids=None, names=None, raw=False, pbar=None):
+        ranges, (min_extract_ts, max_extract_ts) = self.window_byte_ranges(start_secs, extract_duration_secs)
+        streams = []
+        for timeline, min_byte, max_byte in ranges:
+            pid_map = self.pid_maps[self.timelines.index(timeline)]
+            file_pids = None
+            if pids is not None:
+                file_pids = ({pid for pid, merged_pid in pid_map.items() if merged_pid in pids} |
+                             {pid for pid in pids if pid not in pid_map})
+            stream = timeline.iter_events_in_byte_range(min_byte, max_byte, min_extract_ts, max_extract_ts,
+                                                        pids=file_pids, tids=tids, names=names, raw=raw, pbar=pbar)
+            remap = {pid: merged_pid for pid, merged_pid in pid_map.items() if pid != merged_pid}
+            streams.append(remap_pids(stream, remap, raw) if remap else stream)
+        if raw:
+            return heapq.merge(*streams, key=lambda line: self.ts_extractor(line, verbose=False))
+        return heapq.merge(*streams, key=lambda event: event['ts'])
+
+    # Same as HorovodTimeline.extract_and_save_slice()
+    def extract_and_save_slice(self, start_secs, extract_duration_secs, return_slice=False, verbose=False,
+                               passthrough=False, pids=None, tids=None, names=None, output_format="json"):
+        extract_file_path = self.extract_file_path(start_secs, extract_duration_secs, output_format)
+        passthrough = passthrough and output_format == "json"
+        if verbose:
+            print(f'Extract file: {extract_file_path}')
 
+        event_list = [] if return_slice else None
+        ranges, _ = self.window_byte_ranges(start_secs, extract_duration_secs)
+        bytes_to_scan = sum(max_byte - min_byte for _, min_byte, max_byte in ranges)
+        print(f'Merging {humanize_bytes(bytes_to_scan)} from {len(ranges)} of {len(self.timelines)} timelines')
+        time.sleep(0.1)
 
-
-
-
-
+        phase = self.timelines[0].profiler.start("extract")
+        with tqdm(total=bytes_to_scan) as pbar:
+            with open(extract_file_path, 'wb', buffering=EXTRACT_WRITE_BUFFER_BYTES) as o:
+                writer = TRACE_WRITERS[output_format](o, self.metadata_events)
+                for event in self.iter_events(start_secs, extract_duration_secs, pids=pids, tids=tids, names=names,
+                                              raw=passthrough, pbar=pbar):
+                    writer.write(event)
+                    if return_slice:
+                        event_list.append(json.loads(event) if passthrough else event)
+                writer.close()
+        phase.stop()
+
+        return extract_file_path, event_list
+
+
+
+
+# On-disk LRU cache of extracted slices for --serve. Each slice is one file named by the hash of its key. A cache hit
+# bumps the file's mtime, and after every insert the least recently used files are deleted until the cache fits in
+# max_bytes.
+class SliceCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    # Returns the cached slice for key as an open file, or None. An open file stays readable if it is evicted
+    def open(self, key):
+        path = self.path_for(key)
+        with self.lock:
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                return None
+            os.utime(path)
+        return f
+
+    # Returns a (file, tmp_path) to write a new entry to. Pass both to put() when complete, or to discard()
+    def create(self):
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.chmod(tmp_path, 0o644)
+        return os.fdopen(fd, 'wb', buffering=EXTRACT_WRITE_BUFFER_BYTES), tmp_path
+
+    def put(self, key, f, tmp_path):
+        f.close()
+        with self.lock:
+            os.replace(tmp_path, self.path_for(key))
+            self.evict()
+
+    def discard(self, f, tmp_path):
+        f.close()
+        os.remove(tmp_path)
+
+    def entries(self):
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")]
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda entry: entry.stat().st_mtime)
+        total_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+# Writes to several files at once, e.g. a client connection and a cache entry
+class TeeWriter:
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+
+
+# GET /slice?start=<secs>&duration=<secs>[&pids=..&tids=..&names=..] streams a passthrough extract of the window,
+# from the cache if it was served before. GET /stats returns the timeline summary and cache usage.
+class SliceRequestHandler(BaseHTTPRequestHandler):
+    wbufsize = 1024 * 1024
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == "/slice":
+                self.send_slice(query)
+            elif url.path == "/stats":
+                self.send_stats()
+            else:
+                self.send_error(404, f'Unknown path {url.path}. Use /slice?start=<secs>&duration=<secs> or /stats')
+        except (ValueError, KeyError, RuntimeError) as ex:
+            self.send_error(400, str(ex))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_stats(self):
+        h = self.server.timeline()
+        entries = self.server.cache.entries()
+        body = json.dumps({
+            "timeline": h.path,
+            "file_size": h.file_size_bytes,
+            "line_count": h.line_count,
+            "duration_secs": h.duration_secs,
+            "cache_entries": len(entries),
+            "cache_bytes": sum(entry.stat().st_size for entry in entries),
+            "cache_max_bytes": self.server.cache.max_bytes,
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_slice(self, query):
+        start_secs = float(query["start"])
+        duration_secs = float(query["duration"])
+        pids = [int(pid) for pid in query["pids"].split(",")] if query.get("pids") else None
+        tids = [int(tid) for tid in query["tids"].split(",")] if query.get("tids") else None
+        names = query["names"].split(",") if query.get("names") else None
+
+        h = self.server.timeline()
+        # The file size is part of the key so slices are rebuilt once a live timeline has grown
+        key = json.dumps([h.path, h.file_size_bytes, start_secs, duration_secs, pids, tids, names])
+        file_name = os.path.basename(h.extract_file_path(start_secs, duration_secs))
+
+        cached = self.server.cache.open(key)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Disposition", f'attachment; filename="{file_name}"')
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("X-Cache", "hit" if cached else "miss")
+        if cached:
+            with cached:
+                self.send_header("Content-Length", str(os.fstat(cached.fileno()).st_size))
+                self.end_headers()
+                for data in iter(lambda: cached.read(EXTRACT_WRITE_BUFFER_BYTES), b''):
+                    self.wfile.write(data)
+            return
+        self.end_headers()
+
+        # Stream to the client while filling the cache. An aborted download leaves no cache entry
+        f, tmp_path = self.server.cache.create()
+        try:
+            o = TeeWriter(self.wfile, f)
+            o.write(h.metadata_header().encode())
+            for line in h.iter_events(start_secs, duration_secs, pids=pids, tids=tids, names=names, raw=True):
+                o.write(b',\n')
+                o.write(line)
+            o.write(b"\n]")
+        except BaseException:
+            self.server.cache.discard(f, tmp_path)
+            raise
+        self.server.cache.put(key, f, tmp_path)
+
+
+# Serves slices of one timeline over HTTP (see SliceRequestHandler). With live=True the timeline is reloaded, which
+# only scans the appended bytes, when the file has grown since the last request.
+class SliceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, timeline, cache, host="127.0.0.1", port=8000, live=False):
+        super().__init__((host, port), SliceRequestHandler)
+        self._timeline = timeline
+        self.cache = cache
+        self.live = live
+        self.reload_lock = threading.Lock()
+
+    def timeline(self):
+        if self.live:
+            with self.reload_lock:
+                if os.stat(self._timeline.path).st_size != self._timeline.disk_size_bytes:
+                    index_cache = self._timeline.index_cache
+                    self._timeline = HorovodTimeline(self._timeline.path, live=True, workers=self._timeline.workers,
+                                                     ts_extractor=self._timeline.ts_extractor,
+                                                     index_cache_dir=index_cache.directory if index_cache else None,
+                                                     index_cache_bytes=(index_cache.max_bytes if index_cache
+                                                                        else INDEX_CACHE_BYTES))
+        return self._timeline
 
 
 
@@ -612,16 +4011,56 @@ if __name__ == "__main__":
 
     parser.add_argument('--stats', help='Return statistics about the Horovod timeline (file size, duration, line count)', action="store_true")
     parser.add_argument('--extract', help='Extract a portion of the Horovod timeline', action="store_true")
+    parser.add_argument('--extract_batch', help='Extract many windows in a single pass over the timeline. Windows come from --windows and/or --windows_file', action="store_true")
+    parser.add_argument('--op_stats', '--op-stats', help='Stream the whole timeline and report count, total, mean, p50 and p99 duration per operation. Per (op, pid) stats are written to <timeline>.opstats.json', action="store_true")
+    parser.add_argument('--split', help='Cut the whole timeline into consecutive chunks of at most --max_chunk_mb that chrome://tracing or Perfetto can load, each with the metadata events. Chunks are written in parallel with --workers', action="store_true")
+    parser.add_argument('--overview', help='Write a small whole-run trace (<timeline>-overview.json) where short events are merged into aggregate spans per pid/tid and time bucket, to pick windows for --extract', action="store_true")
+    parser.add_argument('--to_columnar', help='Convert the timeline to a columnar dataset (<timeline>.columns/) so later --extract, --op_stats and --stats runs with --columnar are vectorized queries. Querying requires numpy', action="store_true")
+    parser.add_argument('--build_filter_index', help='Index which parts of the timeline hold each event name and pid (<timeline>.fidx.json), so --extract with --names or --pids skips the rest. Rerun to extend it after the timeline grows', action="store_true")
+    parser.add_argument('--serve', help='Keep the timeline loaded and serve GET /slice?start=<secs>&duration=<secs> over HTTP, caching recent slices on disk', action="store_true")
     parser.add_argument('--verify_index', help='Verify that the index makes sense. Note: this does not verify that the index matches the timeline', action="store_true")
 
     parser.add_argument('--live', help='If file has grown since last metadata build, rebuild metadata', action="store_true")
     parser.add_argument('--force_metadata_rebuild', help='Force metadata rebuild', action="store_true")
 
 
-    parser.add_argument('--timeline', type=str, help='Path to horovod_timeline. Required', required=True)
+    parser.add_argument('--timeline', type=str, nargs='+', help='Path to horovod_timeline. Required. --stats and --extract accept several files (e.g. one per restart), which are merged by ts', required=True)
     parser.add_argument('--start_time', help='Start time in seconds. Can be decimal. Default=0', type=float, default=0.)
     parser.add_argument('--duration', help='Duration in seconds of timeline extract. Can be decimal. Default=10', type=float, default=10.)
-
+    parser.add_argument('--start_step', help='Extract training steps instead of seconds, starting at this step (0 is the first step in the timeline)', type=int, default=None)
+    parser.add_argument('--num_steps', help='Number of training steps extracted with --start_step. Default=1', type=int, default=1)
+
+    parser.add_argument('--windows', help='Windows for --extract_batch as comma separated start:duration pairs in seconds, e.g. "0:10,30:5"', type=str, default=None)
+    parser.add_argument('--windows_file', help='File with one window per line for --extract_batch, as "start duration" in seconds', type=str, default=None)
+
+    parser.add_argument('--max_chunk_mb', help='Size cap of each --split chunk in MB. Default=500', type=float, default=500.)
+
+    parser.add_argument('--overview_min_event_ms', help='Events at least this long are kept as they are by --overview. Default=1/1000 of the timeline duration', type=float, default=None)
+    parser.add_argument('--overview_max_events', help=f'Maximum number of events written by --overview. Default={OVERVIEW_MAX_EVENTS}', type=int, default=OVERVIEW_MAX_EVENTS)
+
+    parser.add_argument('--host', help='Address --serve listens on. Default=127.0.0.1', type=str, default="127.0.0.1")
+    parser.add_argument('--port', help='Port --serve listens on. Default=8000', type=int, default=8000)
+    parser.add_argument('--cache_dir', help='Directory of the --serve slice cache. Default=<timeline>.cache/', type=str, default=None)
+    parser.add_argument('--cache_mb', help='Size budget of the --serve slice cache in MB. Least recently served slices are deleted first. Default=2000', type=float, default=2000.)
+
+    parser.add_argument('--pids', help='Only extract events with one of these comma separated pids', type=str, default=None)
+    parser.add_argument('--tids', help='Only extract events with one of these comma separated tids', type=str, default=None)
+    parser.add_argument('--names', help='Only extract events with one of these comma separated names. Note that "E" events have no name', type=str, default=None)
+
+    parser.add_argument('--columnar', help='Answer --extract, --op_stats and --stats from the columnar dataset built by --to_columnar', action="store_true")
+    parser.add_argument('--passthrough', help='Copy the raw bytes of matching lines during --extract instead of decoding and re-encoding each event. Much faster', action="store_true")
+    parser.add_argument('--perfetto', help='Write the --extract output as a Perfetto protobuf trace (.pftrace) instead of JSON', action="store_true")
+    parser.add_argument('--ts_extractor', help='How the ts of each line is read. "fast" scans the raw line and only decodes lines it cannot handle, "json" decodes every line. Default=fast', choices=sorted(TS_EXTRACTORS.keys()), default="fast")
+    parser.add_argument('--workers', help='Number of processes used to scan the timeline when building metadata and by --extract (of at least 64 MB), --op_stats, --split, --overview and --build_filter_index. Default=1', type=int, default=1)
+
+    parser.add_argument('--steps', help='Build the training step index shown by --stats: with the metadata, or in one more pass over the timeline if the metadata exists without it. --start_step builds it when it is missing. Makes the first scan about twice as slow', action="store_true")
+    parser.add_argument('--rollup', help='Build the per-second activity rollup shown by --stats: with the metadata, or in one more pass over the timeline if the metadata exists without it. Makes the first scan several times slower', action="store_true")
+    parser.add_argument('--secs_per_index', help='Seconds of timeline between index entries when the index is built. Default=1', type=float, default=1.)
+    parser.add_argument('--approx', help='With --stats, estimate line count, duration and event rate from a few MB of randomly sampled lines instead of loading or building the metadata', action="store_true")
+    parser.add_argument('--approx_samples', help=f'Lines sampled by --approx. Default={APPROX_SAMPLES}', type=int, default=APPROX_SAMPLES)
+    parser.add_argument('--index_cache_dir', help=f'Keep the index files (.sum.json, .idx, ...) in this shared directory, keyed by a fingerprint of the timeline content, instead of next to the timeline. Default=${INDEX_CACHE_ENV} if set', type=str, default=None)
+    parser.add_argument('--index_cache_mb', help='Size budget of --index_cache_dir in MB. Least recently used entries are deleted first. Default=1000', type=float, default=INDEX_CACHE_BYTES / BYTES_PER_MB)
+    parser.add_argument('--profile', help='Write wall time, bytes and lines read, JSON decodes/failures and RSS of each phase to this JSON file', type=str, default=None)
     parser.add_argument('--verbose', help='Enable verbose mode. Currently poorly implemented. Dont use', type=bool, default=False)
 
     ARGS = parser.parse_args()
@@ -629,42 +4068,177 @@ if __name__ == "__main__":
     # print(ARGS)
     print("")
 
-    modes = [ARGS.stats, ARGS.extract, ARGS.verify_index]
+    modes = [ARGS.stats, ARGS.extract, ARGS.extract_batch, ARGS.split, ARGS.overview, ARGS.op_stats, ARGS.to_columnar,
+             ARGS.build_filter_index, ARGS.serve, ARGS.verify_index]
+    mode_names = ["stats", "extract", "extract_batch", "split", "overview", "op_stats", "to_columnar",
+                  "build_filter_index", "serve", "verify_index"]
     count_modes_chosen = sum([1 for m in modes if m])
     if count_modes_chosen > 1:
         raise RuntimeError(f'Only one of {str(modes)} may be chosen')
     if count_modes_chosen == 0:
         raise RuntimeError(f'One of {str(modes)} must be chosen')
 
-    htimeline_path = abspath(ARGS.timeline)
+    htimeline_paths = [abspath(path) for path in ARGS.timeline]
+    if len(htimeline_paths) > 1 and not (ARGS.stats or ARGS.extract):
+        raise RuntimeError("Only --stats and --extract support several timelines")
+    if len(htimeline_paths) > 1 and ARGS.columnar:
+        raise RuntimeError("--columnar does not support several timelines")
+    if ARGS.start_step is not None and (len(htimeline_paths) > 1 or ARGS.columnar):
+        raise RuntimeError("--start_step does not support several timelines or --columnar")
+    if ARGS.perfetto and ARGS.columnar:
+        raise RuntimeError("--perfetto does not support --columnar")
+    output_format = "perfetto" if ARGS.perfetto else "json"
+
+    if ARGS.approx:
+        # Answered without loading the timelines
+        if not ARGS.stats:
+            raise RuntimeError("--approx only applies to --stats")
+        for htimeline_path in htimeline_paths:
+            print_approximate_stats(approximate_stats(htimeline_path, ARGS.approx_samples,
+                                                      ts_extractor=TS_EXTRACTORS[ARGS.ts_extractor]))
+            print("")
+        sys.exit(0)
 
-    if ARGS.extract:
+    if ARGS.extract and ARGS.start_step is not None:
+        # Step times are only known once the step index is loaded. Use --live to pick up steps written since
+        end_time = None
+
+    elif ARGS.extract:
         end_time = ARGS.start_time + ARGS.duration
 
+    elif ARGS.extract_batch:
+        windows = []
+        if ARGS.windows:
+            for window in ARGS.windows.split(","):
+                start_time, duration = window.split(":")
+                windows.append((float(start_time), float(duration)))
+        if ARGS.windows_file:
+            with open(ARGS.windows_file, 'r') as windows_file:
+                for line in windows_file:
+                    line = line.split("#")[0].replace(",", " ").strip()
+                    if line:
+                        start_time, duration = line.split()
+                        windows.append((float(start_time), float(duration)))
+        if not windows:
+            raise RuntimeError("--extract_batch requires at least one window from --windows or --windows_file")
+        end_time = max(start_time + duration for start_time, duration in windows)
+
     else:
         end_time = None
 
     begin = time.time()
-    h = HorovodTimeline(htimeline_path,
-                        max_extract_time=end_time,
-                        live=ARGS.live,
-                        build_new_summary=ARGS.force_metadata_rebuild)
+    profiler = Profiler()
+    load = profiler.start("load")
+    timeline_args = dict(max_extract_time=end_time,
+                         live=ARGS.live,
+                         build_new_summary=ARGS.force_metadata_rebuild,
+                         secs_per_index=ARGS.secs_per_index,
+                         index_cache_dir=ARGS.index_cache_dir,
+                         index_cache_bytes=int(ARGS.index_cache_mb * BYTES_PER_MB),
+                         workers=ARGS.workers,
+                         ts_extractor=ARGS.ts_extractor,
+                         profiler=profiler,
+                         rollup=ARGS.rollup,
+                         index_steps=ARGS.steps)
+    if len(htimeline_paths) > 1:
+        h = MergedTimeline(htimeline_paths, **timeline_args)
+    else:
+        h = HorovodTimeline(htimeline_paths[0], **timeline_args)
+    load.stop()
+
+    if ARGS.columnar:
+        stale_reason = ColumnarTimeline.stale_reason(h)
+        if stale_reason is not None:
+            print(f'WARNING: {stale_reason}. Reading the timeline instead, rerun --to_columnar to update the dataset')
+            ARGS.columnar = False
 
 
     print("")
     if ARGS.extract:
 
-        print(f'Extracting {ARGS.start_time}s to {end_time}s from {ARGS.timeline}')
+        if ARGS.start_step is not None:
+            print(f'Extracting steps {ARGS.start_step} to {ARGS.start_step + ARGS.num_steps} from {ARGS.timeline[0]}')
+        else:
+            print(f'Extracting {ARGS.start_time}s to {end_time}s from {", ".join(ARGS.timeline)}')
         print("")
-        extract_file_name, _ = h.extract_and_save_slice(ARGS.start_time, ARGS.duration, verbose=ARGS.verbose)
+        pids = [int(pid) for pid in ARGS.pids.split(",")] if ARGS.pids else None
+        tids = [int(tid) for tid in ARGS.tids.split(",")] if ARGS.tids else None
+        names = ARGS.names.split(",") if ARGS.names else None
+        if ARGS.start_step is not None:
+            extract_file_name, _ = h.extract_and_save_steps(ARGS.start_step, ARGS.num_steps, verbose=ARGS.verbose,
+                                                            passthrough=ARGS.passthrough, pids=pids, tids=tids,
+                                                            names=names, output_format=output_format)
+        elif ARGS.columnar:
+            extract_file_name, _ = ColumnarTimeline(h).extract_and_save_slice(ARGS.start_time, ARGS.duration,
+                                                                              pids=pids, tids=tids, names=names)
+        else:
+            extract_file_name, _ = h.extract_and_save_slice(ARGS.start_time, ARGS.duration, verbose=ARGS.verbose,
+                                                            passthrough=ARGS.passthrough, pids=pids, tids=tids,
+                                                            names=names, output_format=output_format)
         print("")
         print(f'Extract complete - {extract_file_name}')
 
+    if ARGS.extract_batch:
+        print(f'Extracting {len(windows)} windows from {ARGS.timeline[0]}')
+        print("")
+        extract_file_names = h.extract_and_save_windows(windows, passthrough=ARGS.passthrough, verbose=ARGS.verbose)
+        print("")
+        print('Extract complete:')
+        for extract_file_name in extract_file_names:
+            print(f'    {extract_file_name}')
+
+    if ARGS.split:
+        print(f'Splitting {ARGS.timeline[0]}')
+        print("")
+        split_file_names = h.split(int(ARGS.max_chunk_mb * BYTES_PER_MB), passthrough=ARGS.passthrough,
+                                   verbose=ARGS.verbose)
+        print("")
+        print('Split complete:')
+        for split_file_name in split_file_names:
+            print(f'    {split_file_name}')
+
+    if ARGS.overview:
+        min_event_secs = ARGS.overview_min_event_ms / 1000. if ARGS.overview_min_event_ms is not None else None
+        overview_file_name = h.overview(min_event_secs=min_event_secs, max_events=ARGS.overview_max_events,
+                                        verbose=ARGS.verbose)
+        print("")
+        print(f'Overview complete - {overview_file_name}')
+
     if ARGS.stats:
         print(f'Timeline Info:')
         print("")
         h.print_stats(verbose=ARGS.verbose)
+        if ARGS.columnar:
+            print("")
+            print('Events by name:')
+            for name, count in sorted(ColumnarTimeline(h).event_counts().items(), key=lambda item: -item[1]):
+                print(f'    {str(name):<32} {humanize(count):>14}')
+
 
+    if ARGS.op_stats:
+        if ARGS.columnar:
+            stats = ColumnarTimeline(h).op_stats()
+        else:
+            stats = h.op_stats(verbose=ARGS.verbose)
+        print("")
+        h.print_op_stats(stats)
+
+    if ARGS.to_columnar:
+        ColumnarTimeline.build(h, verbose=ARGS.verbose)
+
+    if ARGS.build_filter_index:
+        h.build_filter_index(verbose=ARGS.verbose)
+
+    if ARGS.serve:
+        cache = SliceCache(ARGS.cache_dir or h.base_path + ".cache", int(ARGS.cache_mb * BYTES_PER_MB))
+        server = SliceServer(h, cache, host=ARGS.host, port=ARGS.port, live=ARGS.live)
+        print(f'Serving {ARGS.timeline[0]} on http://{ARGS.host}:{server.server_port}/slice?start=<secs>&duration=<secs>')
+        print(f'Slice cache: {cache.directory} ({humanize_bytes(cache.max_bytes)})')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
 
     if ARGS.verify_index:
         print("Checking index is valid:")
@@ -680,6 +4254,27 @@ if __name__ == "__main__":
 
     end = time.time()
 
+    if ARGS.profile:
+        timelines = h.timelines if isinstance(h, MergedTimeline) else [h]
+        profiler.info.update({
+            "timeline": htimeline_paths[0] if len(htimeline_paths) == 1 else htimeline_paths,
+            "mode": [name for name, chosen in zip(mode_names, modes) if chosen][0],
+            "file_size_bytes": h.file_size_bytes,
+            "disk_size_bytes": h.disk_size_bytes,
+            "compression": h.compression,
+            "line_count": h.line_count,
+            "duration_secs": h.duration_secs,
+            "workers": h.workers,
+            "secs_per_index": ARGS.secs_per_index,
+            "bytes_per_index": [timeline.index.bytes_per_index for timeline in timelines],
+            "index_entries": sum(len(timeline.index) for timeline in timelines),
+            "ts_extractor": ARGS.ts_extractor,
+            "json_module": json.__name__,
+            "total_wall_secs": end - begin,
+        })
+        profiler.save(ARGS.profile)
+        print(f'Profile written to {ARGS.profile}')
+
     if ARGS.verbose:
         time.sleep(0.1)
         print("")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Writes a synthetic Horovod timeline for benchmarking extract.py. Output is deterministic: the same arguments always
+# produce the same file.
+#
+# Every training step each tensor (pid) goes through the Horovod allreduce pipeline:
+#   NEGOTIATE_ALLREDUCE (with one instant "X" event per rank as the ranks report ready)
+#   ALLREDUCE, containing MEMCPY_IN_FUSION_BUFFER, NCCL_ALLREDUCE and MEMCPY_OUT_FUSION_BUFFER
+# Tensors run concurrently, so their events interleave and are written slightly out of ts order across tensors, like
+# the timeline writer thread does. Each tensor's own events stay in order. Metadata events (process_name,
+# process_sort_index) are written when a tensor is first seen.
+
+import argparse
+import random
+import sys
+import time
+
+MICROSECONDS_PER_SEC = 1000 * 1000
+BYTES_PER_MB = 1000 * 1000
+
+# Share of a tensor's time in a step spent in each phase
+PHASES = [
+    ("NEGOTIATE_ALLREDUCE", 0.3),
+    ("MEMCPY_IN_FUSION_BUFFER", 0.1),
+    ("NCCL_ALLREDUCE", 0.5),
+    ("MEMCPY_OUT_FUSION_BUFFER", 0.1),
+]
+DTYPES = ["float32", "float16"]
+WRITE_JITTER_US = 1000
+
+
+def print(s):
+    sys.stdout.write(f'{s}\n')
+
+
+def tensor_metadata(pid):
+    return [
+        '{"name": "process_name", "ph": "M", "pid": %d, "args": {"name": "DistributedOptimizer.Allreduce/grad_%d"}}'
+        % (pid, pid),
+        '{"name": "process_sort_index", "ph": "M", "pid": %d, "args": {"sort_index": %d}}' % (pid, pid),
+    ]
+
+
+# Returns the (ts, pid, line) events of one tensor in one step
+def tensor_step_events(r, pid, start_ts, step_us, ranks, shape):
+    events = []
+    ts = start_ts
+    durations = {name: max(int(step_us * share * r.uniform(0.5, 1.0)), 1) for name, share in PHASES}
+
+    negotiate_end = ts + durations["NEGOTIATE_ALLREDUCE"]
+    events.append((ts, pid, '{"ph": "B", "name": "NEGOTIATE_ALLREDUCE", "ts": %d, "pid": %d}' % (ts, pid)))
+    for rank in range(ranks):
+        rank_ts = r.randint(ts, negotiate_end)
+        events.append((rank_ts, pid, '{"ph": "X", "name": "%d", "ts": %d, "pid": %d, "dur": 0}' % (rank, rank_ts, pid)))
+    events.append((negotiate_end, pid, '{"ph": "E", "ts": %d, "pid": %d}' % (negotiate_end, pid)))
+
+    ts = negotiate_end + r.randint(1, 50)
+    events.append((ts, pid, '{"ph": "B", "name": "ALLREDUCE", "ts": %d, "pid": %d, "args": {"dtype": "%s", "shape": "[%d]"}}'
+                   % (ts, pid, DTYPES[pid % len(DTYPES)], shape)))
+    for name, _ in PHASES[1:]:
+        ts += r.randint(1, 50)
+        events.append((ts, pid, '{"ph": "B", "name": "%s", "ts": %d, "pid": %d}' % (name, ts, pid)))
+        ts += durations[name]
+        events.append((ts, pid, '{"ph": "E", "ts": %d, "pid": %d}' % (ts, pid)))
+    ts += r.randint(1, 50)
+    events.append((ts, pid, '{"ph": "E", "ts": %d, "pid": %d}' % (ts, pid)))
+    return events
+
+
+# Writes the timeline and returns (bytes written, events written)
+def generate(path, size_bytes, tensors=100, ranks=8, events_per_sec=100 * 1000, seed=0, start_ts=1000 * 1000):
+    r = random.Random(seed)
+    shapes = [r.choice([1, 64, 1024, 4096, 65536, 1048576]) for _ in range(tensors)]
+    events_per_step = tensors * (ranks + 4 + 2 * (len(PHASES) - 1))
+    step_us = int(events_per_step * MICROSECONDS_PER_SEC / events_per_sec)
+
+    bytes_written = 0
+    events_written = 0
+    seen = set()
+    step_ts = start_ts
+    with open(path, 'w', buffering=16 * 1024 * 1024) as f:
+        f.write('[\n')
+        bytes_written += 2
+        while bytes_written < size_bytes:
+            # Tensors start spread over the first part of the step and overlap each other
+            # Each event is written at its ts plus a small jitter, as in real timelines. The write time never goes back
+            # within a tensor, so the stable sort only reorders events of different tensors
+            step_events = []
+            for pid in range(tensors):
+                tensor_start = step_ts + r.randint(0, step_us // 4)
+                write_ts = 0
+                for event in tensor_step_events(r, pid, tensor_start, step_us // 2, ranks, shapes[pid]):
+                    write_ts = max(write_ts, event[0] + r.randint(0, WRITE_JITTER_US))
+                    step_events.append((write_ts, event))
+            step_events.sort(key=lambda event: event[0])
+            lines = []
+            for _, (ts, pid, line) in step_events:
+                if pid not in seen:
+                    seen.add(pid)
+                    lines.extend(tensor_metadata(pid))
+                lines.append(line)
+            chunk = ',\n'.join(lines) + ',\n'
+            f.write(chunk)
+            bytes_written += len(chunk)
+            events_written += len(lines)
+            step_ts += step_us
+
+    return bytes_written, events_written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="HorovodTimelineGenerator")
+
+    parser.add_argument('--output', type=str, help='Path of the timeline to write. Required', required=True)
+    parser.add_argument('--size_mb', help='Approximate size of the timeline in MB. Default=1000', type=float, default=1000.)
+    parser.add_argument('--tensors', help='Number of tensors (pids). Default=100', type=int, default=100)
+    parser.add_argument('--ranks', help='Number of ranks reporting ready during negotiation. Default=8', type=int, default=8)
+    parser.add_argument('--events_per_sec', help='Events per second of timeline time. Default=100000', type=int, default=100 * 1000)
+    parser.add_argument('--seed', help='Random seed. Default=0', type=int, default=0)
+
+    ARGS = parser.parse_args()
+
+    begin = time.time()
+    bytes_written, events_written = generate(ARGS.output, int(ARGS.size_mb * BYTES_PER_MB), tensors=ARGS.tensors,
+                                             ranks=ARGS.ranks, events_per_sec=ARGS.events_per_sec, seed=ARGS.seed)
+    end = time.time()
+    print(f'Wrote {"{:,}".format(events_written)} events, {"{0:,.2f}".format(bytes_written / BYTES_PER_MB)} MB to '
+          f'{ARGS.output} in {"{0:,.2f}".format(end - begin)}s')